@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Measure how long render_html_table takes to render a wide page of a table with *_meta columns,
+both in full and for the Python side only (formatting the cells and building the filter options,
+with a template that does not render anything).
+
+Each package directory is timed in a subprocess, e.g. to compare two checkouts:
+
+    python benchmarks/render_html.py . ../sprocket-main
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a subprocess with: package directory, number of rows, number of columns, number of runs
+BENCHMARK_CODE = """import json, sys, time
+package, rows, columns, runs = sys.argv[1], *map(int, sys.argv[2:])
+sys.path.insert(0, package)
+import sprocket.render
+from sprocket.render import render_html_table
+
+# Every 11th cell is null and every 13th cell has an error
+message = {"rule": "x", "level": "error", "message": "m"}
+error = json.dumps({"value": "bad", "valid": False, "messages": [message]}, separators=(",", ":"))
+data = []
+for r in range(rows):
+    row = {"row_number": r + 1}
+    for i in range(columns):
+        row[f"c{i}"] = f"value {r}-{i}" if (r + i) % 11 else None
+        row[f"c{i}_meta"] = error if (r + i) % 13 == 0 else None
+    data.append(row)
+args = {"limit": str(rows), "c3": "eq.x", "c5": "not.in.(a,b)"}
+
+
+class EmptyTemplate:
+    def render(self, **kwargs):
+        for row in kwargs.get("rows") or []:
+            pass
+        return ""
+
+
+get_template = sprocket.render.template_env.get_template
+render_html_table(data, "t", args, total=1000)
+full = []
+python = []
+for _ in range(runs):
+    start = time.perf_counter()
+    render_html_table(data, "t", args, total=1000)
+    full.append(time.perf_counter() - start)
+    sprocket.render.template_env.get_template = lambda name: EmptyTemplate()
+    start = time.perf_counter()
+    render_html_table(data, "t", args, total=1000)
+    python.append(time.perf_counter() - start)
+    sprocket.render.template_env.get_template = get_template
+print(min(full) * 1000, min(python) * 1000)"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the time to render an HTML table")
+    parser.add_argument(
+        "packages",
+        nargs="*",
+        help="Directories with the sprocket package to time (default: this checkout)",
+    )
+    parser.add_argument("-r", "--rows", help="Number of rows (default: 100)", type=int, default=100)
+    parser.add_argument(
+        "-c", "--columns", help="Number of columns (default: 200)", type=int, default=200
+    )
+    parser.add_argument("-n", "--runs", help="Number of runs (default: 15)", type=int, default=15)
+    args = parser.parse_args()
+
+    for package in args.packages or [ROOT]:
+        proc = subprocess.run(
+            [sys.executable, "-c", BENCHMARK_CODE, os.path.abspath(package)]
+            + [str(args.rows), str(args.columns), str(args.runs)],
+            capture_output=True,
+            text=True,
+            # Do not import sprocket from the current directory
+            cwd=tempfile.gettempdir(),
+        )
+        if proc.returncode != 0:
+            raise RuntimeError(f"Benchmark for {package} failed:\n{proc.stderr}")
+        full, python = map(float, proc.stdout.split())
+        print(f"{package}: full render {full:.0f} ms, Python side {python:.1f} ms (min)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""Measure how long sprocket takes to handle one request as a CGI script, where every request
+starts a new process (so the time is mostly startup: imports, parsers, and templates).
+
+Each request is run as a subprocess, and the median time and the number of modules loaded are
+printed for each package directory, e.g. to compare two checkouts:
+
+    python benchmarks/startup.py . ../sprocket-main
+"""
+import argparse
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Requests to time: name -> query string
+REQUESTS = {
+    "tsv export": "format=tsv",
+    "html page": "",
+    "html filter": "weight=gt.2",
+}
+
+# Run the CGI entry point and report the number of modules loaded when the process exits
+CGI_CODE = """import atexit, sys
+atexit.register(lambda: sys.stderr.write(f"\\nmodules={len(sys.modules)}\\n"))
+from sprocket.run import main
+main()"""
+
+
+def build_database(path: str):
+    """Create a SQLite database from the test table in tests/resources/test.sql. The *_meta values
+    in test.sql are wrapped in json(...), so they are replaced with the JSON that VALVE writes.
+
+    :param path: path of the database file to create
+    """
+    with open(os.path.join(ROOT, "tests", "resources", "test.sql")) as f:
+        sql = f.read()
+    db = sqlite3.connect(path)
+    db.executescript(sql)
+    db.execute(
+        """UPDATE test SET weight_meta = json(substr(weight_meta, 6, length(weight_meta) - 6))
+        WHERE weight_meta LIKE 'json(%)'"""
+    )
+    db.commit()
+    db.close()
+
+
+def run_cgi(package: str, database: str, table: str, query: str) -> (float, int):
+    """Handle one request with sprocket as a CGI script.
+
+    :param package: directory that contains the sprocket package
+    :param database: path to the database
+    :param table: table to request
+    :param query: query string of the request
+    :return: milliseconds to handle the request, number of modules loaded
+    """
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.path.abspath(package),
+        REQUEST_METHOD="GET",
+        SCRIPT_NAME="",
+        PATH_INFO="/" + table,
+        QUERY_STRING=query,
+        SERVER_NAME="localhost",
+        SERVER_PORT="80",
+        SERVER_PROTOCOL="HTTP/1.1",
+    )
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", CGI_CODE, database, "-c"],
+        env=env,
+        capture_output=True,
+        # Do not import sprocket from the current directory
+        cwd=tempfile.gettempdir(),
+    )
+    ms = (time.perf_counter() - start) * 1000
+    if not proc.stdout.startswith(b"Status: 200"):
+        raise RuntimeError(f"Request for '{query}' failed:\n{proc.stderr.decode()}")
+    modules = int(proc.stderr.decode().rsplit("modules=", 1)[1])
+    return ms, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the startup time of sprocket as a CGI script"
+    )
+    parser.add_argument(
+        "packages",
+        nargs="*",
+        help="Directories with the sprocket package to time (default: this checkout)",
+    )
+    parser.add_argument(
+        "-d", "--database", help="SQLite database (default: built from tests/resources/test.sql)"
+    )
+    parser.add_argument("-t", "--table", help="Table to request (default: test)", default="test")
+    parser.add_argument("-n", "--runs", help="Number of runs (default: 15)", type=int, default=15)
+    args = parser.parse_args()
+    packages = args.packages or [ROOT]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = args.database
+        if not database:
+            database = os.path.join(tmp, "test.db")
+            build_database(database)
+        for name, query in REQUESTS.items():
+            times = {p: [] for p in packages}
+            modules = {}
+            for package in packages:
+                # The first run writes the parser and template caches
+                run_cgi(package, database, args.table, query)
+            for _ in range(args.runs):
+                # Alternate the packages so they are affected equally by any noise
+                for package in packages:
+                    ms, modules[package] = run_cgi(package, database, args.table, query)
+                    times[package].append(ms)
+            for package in packages:
+                print(
+                    f"{name:<12} {package}: median {statistics.median(times[package]):.0f} ms, "
+                    f"{modules[package]} modules"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,11 @@
+import os
+import re
+
 from lark import Lark, Transformer
 
+# Unquoted values that match this pattern (Lark's common.NUMBER) are converted to numbers
+NUMBER = re.compile(r"(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?")
+
 
 class SprocketTransformer(Transformer):
     def NOT(self, args):
@@ -13,11 +19,11 @@ class SprocketTransformer(Transformer):
 
     def value(self, args):
         v = args[0]
-        if v.type == "NUMBER":
-            return int(v)
-        elif v.type == "ESCAPED_STRING":
+        if v.type == "ESCAPED_STRING":
             # Remove surrounding quotes and unescape any internal quotes
             return str(v)[1:-1].replace('\\"', '"')
+        elif NUMBER.fullmatch(v):
+            return int(v) if v.isdigit() else float(v)
         else:
             return str(v)
 
@@ -31,15 +37,14 @@ class SprocketTransformer(Transformer):
         return args
 
 
-PARSER = Lark(
-    """
+GRAMMAR = """
 NOT: "not."
 OPERATOR: "eq" | "gt" | "gte" | "lt" | "lte" | "neq" | "like" | "ilike" | "in" | "is"
 // | "fts" | "plfts" | "phfts" | "wfts" | "cs" | "cd" | "ov" | "sl" | "sr" | "nxr" | "nxl" | "adj"
 
 WORD: /[^,"()]+/
 
-value: NUMBER | ESCAPED_STRING | WORD
+value: ESCAPED_STRING | WORD
 
 lst : "(" value ("," value)* ")"
 
@@ -48,6 +53,28 @@ constraint: lst | value
 start: NOT OPERATOR "." constraint | OPERATOR "." constraint
 
 %import common.ESCAPED_STRING
-%import common.NUMBER
 """
-)
+
+# File to save the LALR parser in, so that new processes (e.g., CGI) do not need to build it
+LALR_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "grammar.lark.cache")
+
+
+def __getattr__(name):
+    """Build the parsers the first time they are used, instead of on import:
+    - PARSER: Earley parser, the results must be transformed with SprocketTransformer
+    - LALR_PARSER: LALR(1) parser with SprocketTransformer embedded, which returns transformed
+      results in one pass. This is loaded from LALR_CACHE when possible."""
+    if name == "PARSER":
+        parser = Lark(GRAMMAR)
+    elif name == "LALR_PARSER":
+        try:
+            parser = Lark(
+                GRAMMAR, parser="lalr", transformer=SprocketTransformer(), cache=LALR_CACHE
+            )
+        except OSError:
+            # The cache cannot be written (e.g., read-only install), so build it every time
+            parser = Lark(GRAMMAR, parser="lalr", transformer=SprocketTransformer())
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = parser
+    return parser
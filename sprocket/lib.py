@@ -1,11 +1,427 @@
-import requests
+import base64
+import builtins
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import tokenize
 
-from lark.exceptions import UnexpectedInput
-from sqlalchemy.engine import Connection
-from sqlalchemy.sql.expression import bindparam
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from io import StringIO
+from sqlalchemy.engine import Connection, ResultProxy
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql.expression import bindparam, TextClause
 from sqlalchemy.sql.expression import text as sql_text
-from typing import Dict, List, Optional, Tuple
-from .grammar import PARSER, SprocketTransformer
+from string import Formatter
+from types import CodeType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TYPE_CHECKING,
+    Union,
+)
+
+if TYPE_CHECKING:
+    # requests is only imported when an HTTPClient sends a request, to keep startup fast
+    import requests
+
+# Violation levels for *_meta columns, ranked from least to most severe
+VIOLATION_LEVELS = {"debug": 0, "info": 1, "warn": 2, "error": 3}
+LEVEL_NAMES = {rank: level for level, rank in VIOLATION_LEVELS.items()}
+
+# Table that holds the violation index (see build_violation_index)
+VIOLATION_INDEX = "sprocket_violations"
+
+# Builtins that can be used in transform expressions
+TRANSFORM_BUILTINS = {
+    name: getattr(builtins, name)
+    for name in [
+        "abs",
+        "all",
+        "any",
+        "bool",
+        "chr",
+        "dict",
+        "divmod",
+        "enumerate",
+        "filter",
+        "float",
+        "format",
+        "hex",
+        "int",
+        "isinstance",
+        "len",
+        "list",
+        "map",
+        "max",
+        "min",
+        "oct",
+        "ord",
+        "pow",
+        "range",
+        "repr",
+        "reversed",
+        "round",
+        "set",
+        "sorted",
+        "str",
+        "sum",
+        "tuple",
+        "zip",
+    ]
+}
+
+# Name that stands in for the placeholder of a transform expression while it is compiled
+TRANSFORM_PLACEHOLDER = "__sprocket_placeholder__"
+
+
+def bind_constraints(query: str, const_dict: dict) -> TextClause:
+    """Create a SQL text query with a bind parameter for each of the constraints in const_dict.
+    Constraints that are lists are expanded (e.g., for IN).
+
+    :param query: SQL query string with :key placeholders
+    :param const_dict: dict of placeholder key -> constraint
+    :return: SQL text query
+    """
+    query = sql_text(query)
+    for k, v in const_dict.items():
+        if isinstance(v, list):
+            query = query.bindparams(bindparam(k, expanding=True))
+        else:
+            query = query.bindparams(bindparam(k))
+    return query
+
+
+def build_violation_index(conn: Connection, table: str) -> int:
+    """Build (or rebuild) the violation index for a table, so that violation filters can be
+    answered by an indexed lookup instead of matching the text of every *_meta column. The index
+    is stored in the VIOLATION_INDEX table, with one row per table, row number, column, and level
+    of the messages in that cell. The rows of the conflict table (<table>_conflict) are indexed
+    as well, under the name of the conflict table, so that the view of both tables can be
+    filtered (this assumes that their row numbers are different, as they are in VALVE). The index
+    is not updated when the table changes, so it must be rebuilt after loading new data.
+
+    :param conn: database connection
+    :param table: name of the table to index, which must have a row_number column
+    :return: number of index rows for the table and its conflict table
+    """
+    columns = get_sql_columns(conn, table)
+    if "row_number" not in columns:
+        raise SprocketError(f"'{table}' must have a row_number column to build a violation index")
+    conflict = f"{table}_conflict"
+
+    count = 0
+    with conn.begin():
+        conn.execute(
+            f'CREATE TABLE IF NOT EXISTS "{VIOLATION_INDEX}" '
+            '("table" TEXT, "row_number" INTEGER, "column" TEXT, "level" TEXT)'
+        )
+        conn.execute(
+            f'CREATE INDEX IF NOT EXISTS "{VIOLATION_INDEX}_idx" '
+            f'ON "{VIOLATION_INDEX}" ("table", "level", "row_number")'
+        )
+        conn.execute(
+            sql_text(f'DELETE FROM "{VIOLATION_INDEX}" WHERE "table" IN (:table, :conflict)'),
+            table=table,
+            conflict=conflict,
+        )
+        # The filter looks up rows by row_number, which needs an index on the table itself
+        # (views cannot be indexed, so these are scanned)
+        if str(conn.engine.url).startswith("sqlite"):
+            is_table = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :table"
+        else:
+            is_table = """SELECT 1 FROM information_schema.tables WHERE table_schema = 'public'
+                AND table_type = 'BASE TABLE' AND table_name = :table"""
+        sources = {table: columns}
+        if conn.execute(sql_text(is_table), table=conflict).first():
+            conflict_columns = get_sql_columns(conn, conflict)
+            if "row_number" in conflict_columns:
+                sources[conflict] = conflict_columns
+        insert = sql_text(
+            f'INSERT INTO "{VIOLATION_INDEX}" ("table", "row_number", "column", "level") '
+            "VALUES (:table, :row_number, :column, :level)"
+        )
+        for source, source_columns in sources.items():
+            if conn.execute(sql_text(is_table), table=source).first():
+                conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS "{source}_row_number_idx" '
+                    f'ON "{source}" ("row_number")'
+                )
+            meta_cols = [x for x in source_columns if x.endswith("_meta")]
+            if not meta_cols:
+                continue
+            select = ", ".join(f'"{m}"' for m in meta_cols)
+            where = " OR ".join(f'"{m}" IS NOT NULL' for m in meta_cols)
+            results = conn.execution_options(stream_results=True).execute(
+                f'SELECT "row_number", {select} FROM "{source}" WHERE {where}'
+            )
+            try:
+                while True:
+                    rows = results.fetchmany(1000)
+                    if not rows:
+                        break
+                    entries = []
+                    for row in rows:
+                        for m in meta_cols:
+                            meta = row[m]
+                            if not meta or '"level"' not in meta:
+                                # No messages, so nothing to index
+                                continue
+                            try:
+                                messages = json.loads(meta).get("messages", [])
+                            except ValueError:
+                                continue
+                            levels = {msg.get("level") for msg in messages}
+                            for level in levels & VIOLATION_LEVELS.keys():
+                                entries.append(
+                                    {
+                                        "table": source,
+                                        "row_number": row["row_number"],
+                                        "column": m[:-5],
+                                        "level": level,
+                                    }
+                                )
+                    if entries:
+                        conn.execute(insert, entries)
+                        count += len(entries)
+            finally:
+                results.close()
+    return count
+
+
+@lru_cache(maxsize=256)
+def compile_transform(column: str, expression: str) -> Callable[[Any], Any]:
+    """Compile a transform expression for a column into a function that is applied to each cell
+    value. The expression is Python code with the {column} placeholder for the value, e.g.
+    "round({weight}, 1)", "'{subject}'.upper()" or "'<a href=\"/x/{id}\">{id}</a>'". A placeholder
+    in a string literal is the value as a string; otherwise it is the value itself (numeric strings
+    are converted to numbers). The expression is only compiled once per column and expression,
+    and runs with a restricted set of builtins (TRANSFORM_BUILTINS). Placeholders in f-strings and
+    bytes literals are substituted as text and evaluated for each value instead.
+
+    :param column: name of the column the expression is applied to
+    :param expression: transform expression
+    :return: function that takes a cell value and returns the transformed value
+    """
+    try:
+        parts = list(Formatter().parse(expression))
+    except ValueError:
+        raise SprocketError(f"Unable to parse transformation for '{column}': {expression}")
+    source = ""
+    for literal, field, spec, conversion in parts:
+        source += literal
+        if field is None:
+            continue
+        if field != column or spec or conversion:
+            raise SprocketError(
+                f"Transformation for '{column}' can only use the {{{column}}} placeholder: "
+                + expression
+            )
+        source += TRANSFORM_PLACEHOLDER
+
+    def compile_source(src: str) -> CodeType:
+        try:
+            code = compile(src, "<transform>", "eval")
+        except SyntaxError:
+            raise SprocketError(f"Unable to compile transformation for '{column}': {expression}")
+        if any(name.startswith("_") for name in get_code_names(code) - {"_value", "_text"}):
+            raise SprocketError(
+                f"Transformation for '{column}' cannot use names starting with '_': {expression}"
+            )
+        return code
+
+    def join_literals(literals: List[Tuple[str, str]]) -> str:
+        # Replace the placeholder in each (prefix, quoted string) literal with _text
+        parts = []
+        for prefix, string in literals:
+            quote = string[:3] if string[:3] in ['"""', "'''"] else string[0]
+            body = string[len(quote) : -len(quote)]
+            pieces = body.split(TRANSFORM_PLACEHOLDER)
+            parts.append(" + _text + ".join(prefix + quote + x + quote for x in pieces))
+        return "(" + " + ".join(parts) + ")"
+
+    # Replace each placeholder with the value (_value) or, in a string literal, the value as a
+    # string (_text). Adjacent string literals are joined with + so that the value can be added.
+    tokens = []
+    literals = []
+    substitute = False
+    try:
+        for token in tokenize.generate_tokens(StringIO(source).readline):
+            if token.type == tokenize.STRING:
+                prefix = token.string[: len(token.string) - len(token.string.lstrip("rRuUbBfF"))]
+                if TRANSFORM_PLACEHOLDER in token.string and set(prefix.lower()) & {"b", "f"}:
+                    substitute = True
+                    break
+                literals.append((prefix, token.string[len(prefix) :]))
+                continue
+            if literals and token.type in [tokenize.NL, tokenize.COMMENT]:
+                continue
+            if literals:
+                tokens.append((tokenize.OP, join_literals(literals)))
+                literals = []
+            if TRANSFORM_PLACEHOLDER not in token.string:
+                tokens.append((token.type, token.string))
+            elif token.type == tokenize.NAME:
+                tokens.append((token.type, "_value"))
+            else:
+                # e.g., a placeholder in an f-string on Python 3.12+
+                substitute = True
+                break
+    except (tokenize.TokenError, SyntaxError):
+        raise SprocketError(f"Unable to compile transformation for '{column}': {expression}")
+
+    if substitute:
+
+        def transform(value):
+            code = compile_source(expression.format(**{column: value}))
+            try:
+                return eval(code, {"__builtins__": TRANSFORM_BUILTINS})
+            except Exception as e:
+                raise SprocketError(
+                    f"Unable to apply transformation for '{column}' to '{value}': {e}"
+                )
+
+        return transform
+
+    code = compile_source(f"lambda _value, _text: ({tokenize.untokenize(tokens)})")
+    func = eval(code, {"__builtins__": TRANSFORM_BUILTINS})
+
+    def transform(value):
+        v = value
+        if isinstance(value, str):
+            for convert in [int, float]:
+                try:
+                    v = convert(value)
+                    break
+                except ValueError:
+                    pass
+        try:
+            return func(v, str(value))
+        except Exception as e:
+            raise SprocketError(f"Unable to apply transformation for '{column}' to '{value}': {e}")
+
+    return transform
+
+
+def count_query(
+    conn: Connection,
+    table: str,
+    columns: Optional[List[str]] = None,
+    where_statements: List[Tuple] = None,
+    violations: List[str] = None,
+    index_table: str = None,
+    json_meta: bool = False,
+    slow_query_log: "SlowQueryLog" = None,
+) -> int:
+    """Get the total number of results for a query on a table, using the same WHERE constraints
+    and violation filters as exec_query.
+
+    :param conn: database connection to query
+    :param table: name of the table to query
+    :param columns: list of all columns in table (required for meta violation filtering)
+    :param where_statements: WHERE constraints for the query as a list of tuples
+                             (operator, constraint)
+    :param violations: violation level(s) to filter meta columns by (requires columns as well)
+    :param index_table: name of the table to filter violations with the violation index of
+                        (see build_violation_index), which is the base table when table is a view
+                        (the index of its conflict table is then used as well)
+    :param json_meta: if True, filter violations with the JSON functions of the database
+    :param slow_query_log: SlowQueryLog to log the query to if it is slow
+    :return: number of results
+    """
+    where, const_dict = get_where_clause(
+        columns=columns,
+        where_statements=where_statements,
+        violations=violations,
+        index_tables=get_index_tables(table, index_table),
+        json_dialect=conn.dialect.name if json_meta else None,
+    )
+    query = f'SELECT COUNT(*) FROM "{table}"' + where
+    start = time.perf_counter()
+    count = conn.execute(bind_constraints(query, const_dict), const_dict).scalar()
+    if slow_query_log:
+        slow_query_log.check(conn, query, const_dict, time.perf_counter() - start)
+    return count
+
+
+def decode_cursor(cursor: str) -> list:
+    """Decode a keyset pagination cursor created by encode_cursor.
+
+    :param cursor: cursor string from query parameters
+    :return: list of the values of the keyset columns
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise SprocketError("Invalid pagination cursor: " + cursor)
+    if not isinstance(values, list):
+        raise SprocketError("Invalid pagination cursor: " + cursor)
+    return values
+
+
+def decode_meta(meta: str) -> Optional[dict]:
+    """Decode the JSON from a *_meta column to get the details needed to display the matching
+    cell. Returns None when the cell is valid and not null, because then nothing needs to change.
+    These cells are recognized without parsing the JSON. Otherwise, the details are a dict with:
+    - value: value to display
+    - style: 'null' for null types, or the most severe violation level of the messages
+             (None when there are no messages)
+    - message: the violation message(s), numbered and joined with line breaks when there are
+               multiple messages (None for null types)
+    - conflict: True if any message is for a primary key conflict
+
+    :param meta: JSON string from a *_meta column
+    :return: dict of display details, or None
+    """
+    if '"nulltype"' not in meta and ('"valid":true' in meta or '"valid": true' in meta):
+        return None
+    metadata = json.loads(meta)
+    if metadata.get("valid") and not metadata.get("nulltype"):
+        return None
+    messages = metadata.get("messages") or []
+    details = {
+        "value": metadata["value"],
+        "style": None,
+        "message": None,
+        # Only primary key conflicts are required to have a rule
+        "conflict": any(msg.get("rule") == "key:primary" for msg in messages),
+    }
+    if "nulltype" in metadata:
+        details["style"] = "null"
+        return details
+    # Use the rank of the violation level to make sure the "worst" violation is displayed
+    rank = -1
+    for msg in messages:
+        rank = max(rank, VIOLATION_LEVELS.get(msg["level"], -1))
+    if rank >= 0:
+        details["style"] = LEVEL_NAMES[rank]
+    if len(messages) > 1:
+        text = "<br>".join(f"({i}) {msg['message']}" for i, msg in enumerate(messages, 1))
+    else:
+        text = "<br>".join(msg["message"] for msg in messages)
+    details["message"] = text.replace('"', "&quot;")
+    return details
+
+
+def encode_cursor(values: list) -> str:
+    """Encode the values of the keyset columns for a row as a URL-safe cursor string.
+
+    :param values: list of the values of the keyset columns
+    :return: cursor string
+    """
+    cursor = json.dumps(values, default=str, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(cursor).decode("utf-8").rstrip("=")
 
 
 def exec_query(
@@ -16,7 +432,16 @@ def exec_query(
     where_statements: List[Tuple] = None,
     order_by: List[str] = None,
     violations: List[str] = None,
-) -> List[dict]:
+    limit: int = None,
+    offset: int = 0,
+    seek: Tuple[str, dict] = None,
+    stream: bool = False,
+    index_table: str = None,
+    json_meta: bool = False,
+    full_meta: bool = True,
+    timings: "Timings" = None,
+    slow_query_log: "SlowQueryLog" = None,
+) -> Union[List[dict], ResultProxy, "CountedRows"]:
     """
     :param conn: database connection to query
     :param table: name of the table to query
@@ -26,60 +451,213 @@ def exec_query(
                              (operator, constraint)
     :param order_by: list of columns to order results by
     :param violations: violation level(s) to filter meta columns by (requires columns as well)
+    :param limit: max number of results to return (default: all results)
+    :param offset: number of results to skip before returning results
+    :param seek: keyset pagination predicate and its constraints (from get_seek_clause)
+    :param stream: if True, use a server-side cursor and return the unfetched results so that rows
+                   can be consumed one at a time without loading the full result set in memory
+    :param index_table: name of the table to filter violations with the violation index of
+                        (see build_violation_index), which is the base table when table is a view
+                        (the index of its conflict table is then used as well)
+    :param json_meta: if True, use the JSON functions of the database (SQLite JSON1 or Postgres
+                      jsonb) on *_meta columns to filter violations, instead of matching text
+    :param full_meta: if False (and json_meta is True), selected *_meta columns are NULL for cells
+                      that are valid and not null on Postgres, so that only the JSON needed to
+                      display the other cells is sent (see decode_meta). SQLite always returns
+                      the full JSON, since it is not sent over a connection.
+    :param timings: Timings of the request to add the query time (as 'query') and number of rows
+                    fetched to. Streamed results are counted as they are fetched (see CountedRows).
+    :param slow_query_log: SlowQueryLog to log the query to if it is slow. For streamed results,
+                           this is the time to start the query, since the rows are fetched later.
     :return: query results
     """
     if not select:
         select = ["*"]
+    dialect = conn.dialect.name if json_meta else None
     query = "SELECT "
     select_strs = []
     for s in select:
         if s == "*":
             select_strs.append("*")
+        elif s.endswith("_meta") and dialect == "postgresql" and not full_meta:
+            # Do not send the JSON of valid cells, since it is not used (see decode_meta)
+            select_strs.append(
+                f'CASE WHEN ("{s}"::jsonb ->> \'valid\') = \'true\' '
+                f'AND ("{s}"::jsonb -> \'nulltype\') IS NULL THEN NULL ELSE "{s}" END AS "{s}"'
+            )
         else:
             select_strs.append(f'"{s}"')
     query += ", ".join(select_strs)
     query += f' FROM "{table}"'
-    const_dict = {}
-    # Add keys for any where statements using user input values
-    if where_statements:
-        n = 0
-        expanded_statements = []
-        for ws, constraint in where_statements:
-            if constraint is None:
-                # Do not use not constraint in case int 0 is provided
-                expanded_statements.append(ws)
-                continue
-            k = f"const{n}"
-            ws += f" :{k}"
-            const_dict[k] = constraint
-            expanded_statements.append(ws)
-            n += 1
-        query += " WHERE " + " AND ".join(expanded_statements)
-    if violations and columns:
-        # Make sure to start this part of the query correctly
-        if not where_statements:
-            query += " WHERE "
-        else:
-            query += " AND "
-        # For each *_meta column, add LIKE filters for the violation levels
-        meta_cols = [x for x in columns if x.endswith("_meta")]
-        meta_filters = []
-        for m in meta_cols:
-            likes = []
-            for v in violations:
-                likes.append(f'trim("{m}") LIKE \'%"level":"{v}"%\'')
-            meta_filters.append("(" + " OR ".join(likes) + ")")
-        query += " OR ".join(meta_filters)
+    where, const_dict = get_where_clause(
+        columns=columns,
+        where_statements=where_statements,
+        violations=violations,
+        seek=seek,
+        index_tables=get_index_tables(table, index_table),
+        json_dialect=dialect,
+    )
+    query += where
     if order_by:
         query += " ORDER BY " + ", ".join(order_by)
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    elif offset and str(conn.engine.url).startswith("sqlite"):
+        # SQLite does not allow OFFSET without LIMIT
+        query += " LIMIT -1"
+    if offset:
+        query += f" OFFSET {int(offset)}"
+    start = time.perf_counter()
+    with time_phase(timings, "query"):
+        if stream:
+            results = conn.execution_options(stream_results=True).execute(
+                bind_constraints(query, const_dict), const_dict
+            )
+        else:
+            results = conn.execute(bind_constraints(query, const_dict), const_dict).fetchall()
+    if slow_query_log:
+        slow_query_log.check(conn, query, const_dict, time.perf_counter() - start)
+    if timings:
+        if stream:
+            return CountedRows(results, timings)
+        timings.rows_fetched += len(results)
+    return results
 
-    query = sql_text(query)
-    for k, v in const_dict.items():
-        if isinstance(v, list):
-            query = query.bindparams(bindparam(k, expanding=True))
+
+def get_code_names(code: CodeType) -> set:
+    """Get all the names (attributes, globals, and variables) used in compiled code, including
+    any nested functions.
+
+    :param code: compiled code object
+    :return: set of names
+    """
+    names = set(code.co_names) | set(code.co_varnames)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names |= get_code_names(const)
+    return names
+
+
+def get_facets(
+    conn: Connection, table: str, columns: List[str], limit: int = 10
+) -> Dict[str, List[dict]]:
+    """Get the most common values of each column with the number of rows that have each value,
+    using one aggregate query per column.
+
+    :param conn: database connection to query
+    :param table: name of the table to query
+    :param columns: columns to get facets for
+    :param limit: max number of values to return for each column
+    :return: dict of column -> list of dicts with value & count, most common first
+    """
+    facets = {}
+    for col in columns:
+        query = (
+            f'SELECT "{col}" AS value, COUNT(*) AS count FROM "{table}" '
+            f'GROUP BY "{col}" ORDER BY count DESC, value LIMIT {int(limit)}'
+        )
+        results = conn.execute(query)
+        facets[col] = [{"value": res["value"], "count": res["count"]} for res in results]
+    return facets
+
+
+def get_index_tables(table: str, index_table: str = None) -> Optional[List[str]]:
+    """Get the names of the tables in the violation index to filter the rows of a table with.
+
+    :param table: name of the table to query
+    :param index_table: name of the indexed table, which is the base table when table is a view
+    :return: list of indexed tables, or None to filter violations without the index
+    """
+    if not index_table:
+        return None
+    if table == index_table:
+        return [table]
+    # The view combines the rows of the table and its conflict table, which are indexed separately
+    return [index_table, f"{index_table}_conflict"]
+
+
+def get_order_by(order_by: List[dict], reverse: bool = False) -> List[str]:
+    """Get the SQL ORDER BY terms from a list of order-specification dicts (see parse_order_by).
+
+    :param order_by: list of order-specification dicts
+    :param reverse: if True, reverse the direction and nulls order of each column
+    :return: list of ORDER BY terms
+    """
+    terms = []
+    for ob in order_by:
+        direction = ob["order"]
+        nulls = ob["nulls"]
+        if reverse:
+            direction = "asc" if direction == "desc" else "desc"
+            nulls = "last" if nulls == "first" else "first"
+        s = [f'"{ob["key"]}"']
+        if direction:
+            s.append(direction.upper())
+        if nulls:
+            s.append("NULLS " + nulls.upper())
+        terms.append(" ".join(s))
+    return terms
+
+
+def get_seek_clause(
+    order_by: List[dict], cursor: list, reverse: bool = False
+) -> Tuple[str, dict]:
+    """Create the keyset pagination predicate that selects the rows that come after the cursor
+    when the results are sorted by the order-specification dicts (see parse_order_by). The last
+    column of order_by must be unique so that each row has a distinct position. This is the
+    expanded form of (col1, col2, ...) > (:seek0, :seek1, ...) which also supports mixed sort
+    directions and NULL values.
+
+    :param order_by: list of order-specification dicts, ending with a unique column
+    :param cursor: values of the order_by columns for the last row seen
+    :param reverse: if True, select the rows that come before the cursor instead
+    :return: predicate and dict of constraints
+    """
+    terms = []
+    equals = []
+    const_dict = {}
+    for n, (ob, value) in enumerate(zip(order_by, cursor)):
+        col = f'"{ob["key"]}"'
+        desc = ob["order"] == "desc"
+        nulls_last = ob["nulls"] != "first"
+        if reverse:
+            desc = not desc
+            nulls_last = not nulls_last
+        if value is None:
+            # Only non-null values come after a null when nulls are sorted first
+            after = None if nulls_last else f"{col} IS NOT NULL"
+            equal = f"{col} IS NULL"
         else:
-            query = query.bindparams(bindparam(k))
-    return conn.execute(query, const_dict).fetchall()
+            k = f"seek{n}"
+            const_dict[k] = value
+            after = f"{col} {'<' if desc else '>'} :{k}"
+            if nulls_last:
+                after = f"({after} OR {col} IS NULL)"
+            equal = f"{col} = :{k}"
+        if after:
+            terms.append(" AND ".join(equals + [after]))
+        equals.append(equal)
+    if not terms:
+        # Nothing comes after this cursor
+        return "1 = 0", const_dict
+    return "(" + " OR ".join(f"({t})" for t in terms) + ")", const_dict
+
+
+def get_sql_column_types(conn: Connection, table: str) -> Dict[str, str]:
+    """Get the declared SQL type of each column in a table.
+
+    :param conn: local database connection
+    :param table: table name to get column types of
+    :return: dict of column name -> SQL type (lowercase, may be empty for SQLite)
+    """
+    if str(conn.engine.url).startswith("sqlite"):
+        res = conn.execute(f"PRAGMA table_info('{table}')")
+    else:
+        res = conn.execute(
+            f"""SELECT column_name AS name, data_type AS type FROM INFORMATION_SCHEMA.COLUMNS
+               WHERE TABLE_NAME = '{table}';"""
+        )
+    return {x["name"]: (x["type"] or "").lower() for x in res}
 
 
 def get_sql_columns(conn: Connection, table: str) -> List[str]:
@@ -100,6 +678,20 @@ def get_sql_columns(conn: Connection, table: str) -> List[str]:
     return [x["name"] for x in res]
 
 
+def get_sql_descriptions(conn: Connection, table: str) -> Dict[str, str]:
+    """Get the descriptions of the columns of a table from the 'column' table.
+
+    :param conn: local database connection
+    :param table: table name to get column descriptions of
+    :return: dict of column name -> description
+    """
+    query = sql_text(
+        """SELECT "column", description FROM "column"
+           WHERE "table" = :table AND description IS NOT NULL"""
+    )
+    return {res["column"]: res["description"] for res in conn.execute(query, table=table)}
+
+
 def get_sql_tables(conn: Connection) -> List[str]:
     """Get a list of tables from a database.
 
@@ -108,28 +700,45 @@ def get_sql_tables(conn: Connection) -> List[str]:
     """
     if str(conn.engine.url).startswith("sqlite"):
         res = conn.execute(
-            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE '%_conflict';"
+            f"""SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE '%_conflict'
+            AND name != '{VIOLATION_INDEX}';"""
         )
     else:
         res = conn.execute(
-            """SELECT table_name AS name FROM information_schema.tables
-            WHERE table_schema = 'public' AND table_name NOT LIKE '%_conflict';"""
+            f"""SELECT table_name AS name FROM information_schema.tables
+            WHERE table_schema = 'public' AND table_name NOT LIKE '%_conflict'
+            AND table_name != '{VIOLATION_INDEX}';"""
         )
     return [x["name"] for x in res]
 
 
-def get_swagger_tables(url: str) -> List[str]:
+def get_swagger_order(url: str, table: str, client: "HTTPClient" = None) -> Optional[str]:
+    """Use the URL (Swagger endpoint) to get an order for the rows of a table that is the same for
+    every request, so that it can be requested one page at a time. This is the primary key of the
+    table if the endpoint marks it (as PostgREST does), otherwise all the columns.
+
+    :param url: Swagger endpoint
+    :param table: table name
+    :param client: HTTPClient to send the request with (default: DEFAULT_HTTP_CLIENT)
+    :return: value for the 'order' query parameter, or None if the columns are not described
+    """
+    r = (client or DEFAULT_HTTP_CLIENT).get(url, schema=True)
+    try:
+        columns = r.json()["definitions"][table]["properties"]
+    except (KeyError, TypeError, ValueError):
+        return None
+    key = [c for c, details in columns.items() if "<pk/>" in details.get("description", "")]
+    return ",".join(key or columns) or None
+
+
+def get_swagger_tables(url: str, client: "HTTPClient" = None) -> List[str]:
     """Use the URL (Swagger endpoint) to get a list of tables.
 
     :param url: Swagger endpoint
+    :param client: HTTPClient to send the request with (default: DEFAULT_HTTP_CLIENT)
     :return list of tables
     """
-    try:
-        r = requests.get(url, verify=False)
-    except requests.exceptions.MissingSchema:
-        raise SprocketError("Malformed endpoint URL: " + url)
-    except ConnectionError:
-        raise SprocketError("Unable to connect to endpoint: " + url)
+    r = (client or DEFAULT_HTTP_CLIENT).get(url, schema=True)
     data = r.json()
     try:
         return [
@@ -139,6 +748,30 @@ def get_swagger_tables(url: str) -> List[str]:
         raise SprocketError("Malformed Swagger data from endpoint: " + url)
 
 
+def get_swagger_url(
+    swagger_url: str, table: str, request_args: dict, default_limit: int = 100
+) -> str:
+    """Get the URL to request a page of a table from a Swagger endpoint. The 'format',
+    'expand_meta', and 'violations' parameters are not supported by the endpoint, so they are not
+    included.
+
+    :param swagger_url: URL to remote database (Swagger)
+    :param table: table name
+    :param request_args: dict of HTTP request args (Flask request.args)
+    :param default_limit: if limit parameter is not provided, default number of results to request
+    :return: URL for the endpoint
+    """
+    swagger_request_args = [
+        f"{arg}={value}"
+        for arg, value in request_args.items()
+        if arg not in ["expand_meta", "format", "violations"]
+    ]
+    if "limit" not in request_args:
+        # We always want to have the limit
+        swagger_request_args.append(f"limit={default_limit}")
+    return swagger_url + "/" + table + "?" + "&".join(swagger_request_args)
+
+
 def get_urls(
     base_url: str,
     request_args: dict,
@@ -146,6 +779,7 @@ def get_urls(
     ignore_params: list = None,
     offset: int = 0,
     limit: int = 100,
+    cursors: Dict[str, str] = None,
 ) -> Dict[str, str]:
     """Use the offset and limit to create important URLs for pagination in the HTML table output.
     This is a dict with 5 keys:
@@ -161,6 +795,9 @@ def get_urls(
     :param ignore_params: list of query parameters to exclude from URLs
     :param offset: current 'location' (where to begin displaying results)
     :param limit: number of results to display per page
+    :param cursors: keyset pagination cursors for the "prev" (first row) and "next" (last row)
+                    pages. When provided, the URLs include 'before' and 'after' query parameters.
+                    The offset is still included so that the location can be displayed.
     :return: dict of URLs
     """
     if not ignore_params:
@@ -173,16 +810,21 @@ def get_urls(
     if offset > 0:
         # Only include "previous" and "first" if we aren't at the beginning
         prev_args = request_args.copy()
+        prev_args.pop("after", None)
+        prev_args.pop("before", None)
         prev_offset = offset - limit
         if prev_offset < 0:
             prev_offset = 0
         prev_args["offset"] = prev_offset
+        if cursors and prev_offset > 0:
+            prev_args["before"] = cursors["prev"]
         prev_query = [f"{k}={v}" for k, v in prev_args.items() if k not in ignore_params]
         prev_url = base_url
         if prev_query:
             prev_url += "?" + "&".join(prev_query)
 
         del prev_args["offset"]
+        prev_args.pop("before", None)
         first_query = [f"{k}={v}" for k, v in prev_args.items() if k not in ignore_params]
         first_url = base_url
         if first_query:
@@ -190,13 +832,21 @@ def get_urls(
     if limit + offset < total_results:
         # Only include "next" and "last" link if we aren't at the end
         next_args = request_args.copy()
+        next_args.pop("after", None)
+        next_args.pop("before", None)
         next_args["offset"] = limit + offset
+        if cursors:
+            next_args["after"] = cursors["next"]
         next_query = [f"{k}={v}" for k, v in next_args.items() if k not in ignore_params]
         next_url = base_url
         if next_query:
             next_url += "?" + "&".join(next_query)
 
         next_args["offset"] = total_results - limit
+        if cursors:
+            # The last page is the first page of results in reverse order
+            del next_args["after"]
+            next_args["before"] = "last"
         last_query = [f"{k}={v}" for k, v in next_args.items() if k not in ignore_params]
         last_url = base_url
         if last_query:
@@ -216,6 +866,171 @@ def get_urls(
     }
 
 
+def get_violation_counts(
+    conn: Connection,
+    table: str,
+    columns: List[str],
+    json_meta: bool = False,
+    violation_index: bool = False,
+) -> Dict[str, Dict[str, int]]:
+    """Count the cells with messages at each violation level in each column that has a *_meta
+    column. The counts are computed with one aggregate query over the table.
+
+    :param conn: database connection to query
+    :param table: name of the table to query
+    :param columns: list of all columns in table
+    :param json_meta: if True, match violation levels with the JSON functions of the database
+    :param violation_index: if True, count the violations in the violation index for the table
+                            (see build_violation_index) instead of the *_meta columns
+    :return: dict of column -> violation level -> number of cells with a message at that level
+    """
+    meta_cols = [x for x in columns if x.endswith("_meta")]
+    counts = {m[:-5]: {level: 0 for level in VIOLATION_LEVELS} for m in meta_cols}
+    if not meta_cols:
+        return counts
+    if violation_index:
+        query = sql_text(
+            f'SELECT "column", "level", COUNT(*) AS count FROM "{VIOLATION_INDEX}" '
+            'WHERE "table" = :table GROUP BY "column", "level"'
+        )
+        for res in conn.execute(query, table=table):
+            if res["column"] in counts:
+                counts[res["column"]][res["level"]] = res["count"]
+        return counts
+    json_dialect = conn.dialect.name if json_meta else None
+    sums = []
+    for m in meta_cols:
+        for level in VIOLATION_LEVELS:
+            condition = get_violation_filter(m, [level], json_dialect=json_dialect)
+            sums.append(f"SUM(CASE WHEN {condition} THEN 1 ELSE 0 END)")
+    values = iter(conn.execute(f'SELECT {", ".join(sums)} FROM "{table}"').first())
+    for m in meta_cols:
+        for level in VIOLATION_LEVELS:
+            counts[m[:-5]][level] = next(values) or 0
+    return counts
+
+
+def get_violation_filter(meta_col: str, levels: List[str], json_dialect: str = None) -> str:
+    """Get the SQL condition for cells that have a message at one of the violation levels in
+    their *_meta column.
+
+    :param meta_col: name of the *_meta column
+    :param levels: violation levels to match
+    :param json_dialect: if provided ('sqlite' or 'postgresql'), match the levels with the JSON
+                         functions of this database instead of matching the text of the column
+    :return: SQL condition
+    """
+    for level in levels:
+        if level not in VIOLATION_LEVELS:
+            raise SprocketError(f"'{level}' is not a valid violation level")
+    if json_dialect == "sqlite":
+        # Skip the JSON of cells without messages (most cells) before parsing it
+        in_levels = ", ".join(f"'{level}'" for level in levels)
+        return (
+            f'(instr("{meta_col}", \'"level"\') AND json_valid("{meta_col}") AND EXISTS '
+            f'(SELECT 1 FROM json_each("{meta_col}", \'$.messages\') AS msg '
+            f"WHERE json_extract(msg.value, '$.level') IN ({in_levels})))"
+        )
+    if json_dialect:
+        # Containment can use a GIN index on ("<column>_meta"::jsonb)
+        conditions = [
+            f'"{meta_col}"::jsonb @> \'{{"messages":[{{"level":"{level}"}}]}}\''
+            for level in levels
+        ]
+    else:
+        conditions = [f'trim("{meta_col}") LIKE \'%"level":"{level}"%\'' for level in levels]
+    return "(" + " OR ".join(conditions) + ")"
+
+
+def get_where_clause(
+    columns: Optional[List[str]] = None,
+    where_statements: List[Tuple] = None,
+    violations: List[str] = None,
+    seek: Tuple[str, dict] = None,
+    index_tables: List[str] = None,
+    json_dialect: str = None,
+) -> Tuple[str, dict]:
+    """Build the WHERE clause of a query from the WHERE constraints and violation levels. The
+    clause uses placeholders for all user input values, which are returned in a dict of
+    placeholder key -> constraint so that we can use them in parameterized queries.
+
+    :param columns: list of all columns in table (required for meta violation filtering)
+    :param where_statements: WHERE constraints for the query as a list of tuples
+                             (operator, constraint)
+    :param violations: violation level(s) to filter meta columns by (requires columns as well)
+    :param seek: keyset pagination predicate and its constraints (from get_seek_clause)
+    :param index_tables: if provided, filter violations with the violation index for these tables
+                         (see build_violation_index) instead of the *_meta columns
+    :param json_dialect: if provided ('sqlite' or 'postgresql'), filter violations with the JSON
+                         functions of this database instead of matching the *_meta text
+    :return: WHERE clause (empty string when there are no constraints) and dict of constraints
+    """
+    clauses = []
+    const_dict = {}
+    # Add keys for any where statements using user input values
+    if where_statements:
+        n = 0
+        for ws, constraint in where_statements:
+            if constraint is None:
+                # Do not use not constraint in case int 0 is provided
+                clauses.append(ws)
+                continue
+            k = f"const{n}"
+            ws += f" :{k}"
+            const_dict[k] = constraint
+            clauses.append(ws)
+            n += 1
+    if violations and index_tables:
+        clauses.append(
+            f'"row_number" IN (SELECT "row_number" FROM "{VIOLATION_INDEX}" '
+            'WHERE "table" IN :vtables AND "level" IN :vlevels)'
+        )
+        const_dict["vtables"] = list(index_tables)
+        const_dict["vlevels"] = list(violations)
+    elif violations and columns:
+        # For each *_meta column, add filters for the violation levels
+        meta_filters = [
+            get_violation_filter(x, violations, json_dialect=json_dialect)
+            for x in columns
+            if x.endswith("_meta")
+        ]
+        if meta_filters:
+            clauses.append("(" + " OR ".join(meta_filters) + ")")
+    if seek:
+        clauses.append(seek[0])
+        const_dict.update(seek[1])
+    if not clauses:
+        return "", const_dict
+    return " WHERE " + " AND ".join(clauses), const_dict
+
+
+@lru_cache(maxsize=1024)
+def parse_condition(where: str, lalr: bool = True) -> Optional[tuple]:
+    """Parse a horizontal filtering condition with the Lark grammar. Results are cached, since
+    the same conditions are requested over and over.
+
+    :param where: where condition (operator + constraint modeled on
+                  https://postgrest.org/en/latest/api.html#operators)
+    :param lalr: if True, use the LALR parser with the embedded transformer (one pass), otherwise
+                 use the Earley parser and then transform the parse tree
+    :return: tuple of ("not" (optional), operator, constraint) where a list constraint is a tuple,
+             or None if the condition cannot be parsed
+    """
+    # Lark is only imported when a condition is parsed, to keep startup (e.g., CGI) fast
+    from lark.exceptions import UnexpectedInput
+    from . import grammar
+
+    try:
+        if lalr:
+            res = grammar.LALR_PARSER.parse(where)
+        else:
+            res = grammar.SprocketTransformer().transform(grammar.PARSER.parse(where))
+    except UnexpectedInput:
+        return None
+    # Cached results must be immutable
+    return tuple(tuple(x) if isinstance(x, list) else x for x in res)
+
+
 def parse_order_by(order: str) -> List[dict]:
     """Return a list of columns to order by from a string passed through query parameters. The
     format is modeled on https://postgrest.org/en/latest/api.html#ordering. Each column is
@@ -262,7 +1077,7 @@ def parse_order_by(order: str) -> List[dict]:
     return order_by
 
 
-def parse_where(where: str, column, postgres=False) -> Tuple[str, str]:
+def parse_where(where: str, column, postgres=False, lalr=True) -> Tuple[str, str]:
     """Create a where clause by parsing the horizontal filtering condition.
     The WHERE is a tuple containing the operator (e.g., LIKE) and the constraint (e.g., "foo", or
     None for some like NULL) so that we can use the constraints in parameterized queries.
@@ -271,13 +1086,13 @@ def parse_where(where: str, column, postgres=False) -> Tuple[str, str]:
                   https://postgrest.org/en/latest/api.html#operators)
     :param column: column to apply filter
     :param postgres: if True, use Postgres syntax which includes ILIKE
+    :param lalr: if True, parse with the LALR parser, otherwise use the Earley parser
     :return: a tuple (where statement, constraint)"""
     # Parse using Lark grammar
-    try:
-        parsed = PARSER.parse(where)
-    except UnexpectedInput:
+    res = parse_condition(where, lalr=lalr)
+    if res is None:
         raise SprocketError(f"Invalid filter constraint for column '{column}': {where}")
-    res = SprocketTransformer().transform(parsed)
+    res = [list(x) if isinstance(x, tuple) else x for x in res]
     if len(res) == 3:
         # NOT operator included
         operator = res[1]
@@ -340,5 +1155,912 @@ def parse_where(where: str, column, postgres=False) -> Tuple[str, str]:
     return statement + f"{col_name} {query_op}", constraint
 
 
+@contextmanager
+def time_phase(timings: Optional["Timings"], name: str):
+    """Add the time spent in a block to a phase of the timings of a request (if any).
+
+    :param timings: Timings of the request, or None to do nothing
+    :param name: name of the phase
+    """
+    if timings is None:
+        yield
+        return
+    timings.start(name)
+    try:
+        yield
+    finally:
+        timings.stop()
+
+
+class Cell:
+    """Value of one cell of a table, formatted for display in the HTML templates. Templates can
+    access the fields as items (cell["display"]) or attributes (cell.display)."""
+
+    __slots__ = ("header", "value", "display", "style", "message", "conflict_key")
+
+    def __init__(self, header: str, value: Any, display: str, style: Optional[str] = None):
+        """
+        :param header: name of the column
+        :param value: value of the cell ("" for null values)
+        :param display: value to display, after any transform
+        :param style: violation level or "null" to style the cell with
+        """
+        self.header = header
+        self.value = value
+        self.display = display
+        self.style = style
+        # Violation messages to display as a tooltip
+        self.message = None  # type: Optional[str]
+        # Value to use as the row key when this is the primary key
+        self.conflict_key = None  # type: Any
+
+    def __getitem__(self, key: str) -> Any:
+        return getattr(self, key)
+
+
+class CountedRows:
+    """Wrapper for query results that counts the rows in the timings of a request as they are
+    fetched (see Timings). Rows can be fetched by iterating over the results or with fetchmany."""
+
+    def __init__(self, rows: ResultProxy, timings: "Timings"):
+        """
+        :param rows: query results
+        :param timings: Timings of the request
+        """
+        self.rows = rows
+        self.timings = timings
+        # Set to True when the rows are sent as they are fetched (e.g., exports)
+        self.rendered = False
+
+    def __iter__(self):
+        for row in self.rows:
+            self._count(1)
+            yield row
+
+    def close(self):
+        self.rows.close()
+
+    def fetchmany(self, size: int) -> list:
+        rows = self.rows.fetchmany(size)
+        self._count(len(rows))
+        return rows
+
+    def _count(self, n: int):
+        self.timings.rows_fetched += n
+        if self.rendered:
+            self.timings.rows_rendered += n
+
+
+class HTTPClient:
+    """Client for requests to Swagger endpoints. All requests share one keep-alive session with a
+    pool of connections, so that each request does not need a new TCP/TLS handshake.
+
+    Responses are cached by URL (and request headers) when the endpoint allows it. A cached
+    response is reused until its Cache-Control max-age has passed. After that, it is revalidated
+    with its ETag or Last-Modified date, and reused if the endpoint responds with 304 Not
+    Modified. Responses with Cache-Control no-store, or with neither a max-age nor a validator,
+    are not cached.
+
+    With a cache_dir, the endpoint schema (and table pages, with cache_pages) are also saved to
+    disk, so that they are reused across restarts and CGI processes. Saved responses without any
+    caching headers are reused until they are removed from the cache directory. The least recently
+    used files are removed when the directory grows larger than disk_cache_size.
+
+    Pages can also be fetched in the background with prefetch (e.g., the next page of a table).
+    Prefetched responses are kept for prefetch_ttl seconds and used for the first matching get,
+    which waits for the prefetch to finish instead of sending the same request again."""
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        timeout: Optional[float] = 30,
+        cache_size: int = 128,
+        verify: bool = False,
+        cache_dir: Optional[str] = None,
+        cache_pages: bool = False,
+        disk_cache_size: int = 64 * 1024 * 1024,
+        prefetch_workers: int = 2,
+        prefetch_ttl: float = 30,
+    ):
+        """
+        :param pool_size: max number of connections to keep open per host
+        :param timeout: seconds to wait for the endpoint to connect or send data (None to wait
+                        forever)
+        :param cache_size: max number of responses to cache (0 to disable the cache)
+        :param verify: if True, verify TLS certificates
+        :param cache_dir: directory to save responses in (None to only cache in memory)
+        :param cache_pages: if True, save table pages in cache_dir as well as the endpoint schema
+        :param disk_cache_size: max total size in bytes of the files in cache_dir
+        :param prefetch_workers: number of threads to prefetch pages with (0 to disable prefetch)
+        :param prefetch_ttl: seconds to keep prefetched responses
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.verify = verify
+        self.cache_dir = cache_dir
+        self.cache_pages = cache_pages
+        self.disk_cache_size = disk_cache_size
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_ttl = prefetch_ttl
+        # (url, headers) -> (expiration time, response)
+        self._cache = OrderedDict()  # type: OrderedDict
+        self._prefetched = OrderedDict()  # type: OrderedDict
+        # (url, headers) -> Future for prefetches that have not finished
+        self._pending = {}  # type: Dict[tuple, Future]
+        self._executor = None  # type: Optional[ThreadPoolExecutor]
+        self._session = None  # type: Optional[requests.Session]
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.prune()
+
+    def clear(self):
+        """Remove all responses from the cache, including any saved in the cache directory."""
+        with self._lock:
+            self._cache.clear()
+            self._prefetched.clear()
+        if self.cache_dir:
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".json"):
+                    os.remove(entry.path)
+
+    def get(self, url: str, headers: dict = None, schema: bool = False) -> "requests.Response":
+        """Send a GET request, or get the response from the cache.
+
+        :param url: URL to send request to
+        :param headers: dict of request headers
+        :param schema: if True, the response is the endpoint schema, which is always saved when
+                       there is a cache directory
+        :return: response
+        """
+        headers = headers or {}
+        key = (url, tuple(sorted(headers.items())))
+        with self._lock:
+            future = self._pending.get(key)
+        if future:
+            # Wait for the prefetch instead of sending the same request
+            try:
+                future.result(timeout=self.timeout)
+            except Exception:
+                pass
+        with self._lock:
+            prefetched = self._prefetched.pop(key, None)
+        if prefetched and prefetched[0] > time.time():
+            return prefetched[1]
+        return self._get(key, schema=schema)
+
+    @staticmethod
+    def get_max_age(r: "requests.Response") -> Optional[float]:
+        """Get the number of seconds a response can be reused from the cache without revalidating.
+
+        :param r: response
+        :return: seconds (0 to always revalidate), or None if the response cannot be cached
+        """
+        directives = {}
+        for d in r.headers.get("Cache-Control", "").lower().split(","):
+            k, _, v = d.strip().partition("=")
+            directives[k] = v.strip('"')
+        if "no-store" in directives or "private" in directives:
+            return None
+        can_revalidate = "ETag" in r.headers or "Last-Modified" in r.headers
+        if "no-cache" in directives:
+            return 0 if can_revalidate else None
+        try:
+            return float(directives["max-age"])
+        except (KeyError, ValueError):
+            return 0 if can_revalidate else None
+
+    def get_path(self, key: tuple) -> str:
+        """Get the path of the file in the cache directory for a cache key.
+
+        :param key: (url, headers) cache key
+        :return: file path
+        """
+        digest = hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest + ".json")
+
+    def load(self, key: tuple) -> Optional[Tuple[float, "requests.Response"]]:
+        """Load a response from the cache directory.
+
+        :param key: (url, headers) cache key
+        :return: (expiration time, response), or None if the response has not been saved
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, "r") as f:
+                saved = json.load(f)
+            # Mark the file as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        import requests
+        from requests.structures import CaseInsensitiveDict
+
+        r = requests.Response()
+        r.url = saved["url"]
+        r.status_code = saved["status"]
+        r.headers = CaseInsensitiveDict(saved["headers"])
+        r.encoding = saved["encoding"]
+        r._content = base64.b64decode(saved["content"])
+        return saved["expires"] or float("inf"), r
+
+    def prefetch(self, url: str, headers: dict = None):
+        """Send a GET request in the background, so that a later get for the same URL and headers
+        does not need to wait for the endpoint. Errors are ignored (the later get will raise them).
+
+        :param url: URL to send request to
+        :param headers: dict of request headers
+        """
+        if not self.prefetch_workers:
+            return
+        headers = headers or {}
+        key = (url, tuple(sorted(headers.items())))
+        with self._lock:
+            if key in self._pending or key in self._prefetched:
+                return
+            entry = self._cache.get(key)
+            if entry and entry[0] > time.time():
+                return
+            if not self._executor:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.prefetch_workers, thread_name_prefix="sprocket-prefetch"
+                )
+            self._pending[key] = self._executor.submit(self._prefetch, key)
+
+    def prune(self):
+        """Remove the least recently used files from the cache directory until its total size is
+        no larger than disk_cache_size."""
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(f[1] for f in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_cache_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Another process already removed it
+                pass
+            total -= size
+
+    def save(self, key: tuple, entry: Tuple[float, "requests.Response"]):
+        """Save a response to the cache directory.
+
+        :param key: (url, headers) cache key
+        :param entry: (expiration time, response)
+        """
+        expires, r = entry
+        saved = {
+            "url": r.url,
+            "status": r.status_code,
+            "headers": dict(r.headers),
+            "encoding": r.encoding,
+            "content": base64.b64encode(r.content).decode("ascii"),
+            # JSON has no infinity, so use null for responses that never expire
+            "expires": expires if expires != float("inf") else None,
+        }
+        path = self.get_path(key)
+        # Write to a temporary file first so other processes never read a partial file
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(saved, f)
+        os.replace(tmp, path)
+        self.prune()
+
+    @property
+    def session(self) -> "requests.Session":
+        """Keep-alive session for all requests, created on first use.
+
+        :return: session with a pool of pool_size connections per host
+        """
+        with self._lock:
+            if not self._session:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                self._session = requests.Session()
+                self._session.mount("http://", adapter)
+                self._session.mount("https://", adapter)
+            return self._session
+
+    def store(self, key: tuple, entry: Tuple[float, "requests.Response"]):
+        """Add a response to the in-memory cache, removing the least recently used responses
+        if the cache is full.
+
+        :param key: (url, headers) cache key
+        :param entry: (expiration time, response)
+        """
+        if not self.cache_size:
+            return
+        with self._lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _get(self, key: tuple, schema: bool = False) -> "requests.Response":
+        """Send a GET request, or get the response from the cache (not including prefetched
+        responses).
+
+        :param key: (url, headers) cache key
+        :param schema: if True, the response is the endpoint schema
+        :return: response
+        """
+        url, headers = key[0], dict(key[1])
+        save = self.cache_dir is not None and (schema or self.cache_pages)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry:
+                self._cache.move_to_end(key)
+        if not entry and save:
+            entry = self.load(key)
+            if entry:
+                self.store(key, entry)
+        now = time.time()
+        if entry and entry[0] > now:
+            return entry[1]
+
+        request_headers = dict(headers)
+        if entry:
+            # Revalidate the expired response
+            if entry[1].headers.get("ETag"):
+                request_headers["If-None-Match"] = entry[1].headers["ETag"]
+            if entry[1].headers.get("Last-Modified"):
+                request_headers["If-Modified-Since"] = entry[1].headers["Last-Modified"]
+        import requests
+
+        try:
+            r = self.session.get(
+                url, headers=request_headers, timeout=self.timeout, verify=self.verify
+            )
+        except (requests.exceptions.MissingSchema, requests.exceptions.InvalidURL):
+            raise SprocketError("Malformed endpoint URL: " + url)
+        except requests.exceptions.Timeout:
+            raise SprocketError("Request to endpoint timed out: " + url)
+        except requests.exceptions.ConnectionError:
+            raise SprocketError("Unable to connect to endpoint: " + url)
+
+        if r.status_code == 304 and entry:
+            r = entry[1]
+            max_age = self.get_max_age(r)
+        elif r.status_code == 200 and (self.cache_size or save):
+            max_age = self.get_max_age(r)
+        else:
+            return r
+        no_store = "no-store" in r.headers.get("Cache-Control", "").lower()
+        if max_age is None and save and not no_store:
+            # Saved responses without caching headers are kept until the cache is cleared
+            max_age = float("inf")
+        if max_age is None:
+            with self._lock:
+                self._cache.pop(key, None)
+            return r
+        entry = (now + max_age, r)
+        self.store(key, entry)
+        if save:
+            self.save(key, entry)
+        return r
+
+    def _prefetch(self, key: tuple):
+        """Get a response for prefetch and keep it for prefetch_ttl seconds.
+
+        :param key: (url, headers) cache key
+        """
+        try:
+            r = self._get(key)
+            if r.status_code == 200:
+                with self._lock:
+                    self._prefetched[key] = (time.time() + self.prefetch_ttl, r)
+                    # Only keep as many prefetched responses as can be used at once
+                    while len(self._prefetched) > self.prefetch_workers * 4:
+                        self._prefetched.popitem(last=False)
+        except SprocketError as e:
+            logging.debug("Prefetch failed: " + str(e))
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+
+class LazyList:
+    """Sequence that applies a function to each item of a list only when it is iterated over, so
+    that the results do not all need to be kept in memory (e.g., rows formatted for a template).
+    The function is applied again each time the sequence is iterated over."""
+
+    def __init__(self, items: list, func: Callable[[Any], Any]):
+        """
+        :param items: list of items
+        :param func: function to apply to each item
+        """
+        self.items = items
+        self.func = func
+
+    def __iter__(self):
+        return map(self.func, self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class Metrics:
+    """Totals of the timings of all requests handled by this process (see Timings), which can be
+    rendered in the Prometheus text format. Each worker process has its own totals."""
+
+    # Upper bounds (in seconds) of the buckets of the request duration histogram
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        # (endpoint, status) -> number of requests
+        self.requests = {}  # type: Dict[Tuple[str, int], int]
+        # endpoint -> [count for each bucket (not cumulative), sum of durations, count]
+        self.durations = {}  # type: Dict[str, list]
+        # phase -> total seconds
+        self.phases = {}  # type: Dict[str, float]
+        self.rows_fetched = 0
+        self.rows_rendered = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+
+    def observe(self, timings: "Timings", endpoint: str, status: int):
+        """Add the timings of a finished request to the totals.
+
+        :param timings: Timings of the request (see Timings.finish)
+        :param endpoint: name of the endpoint that handled the request
+        :param status: HTTP status code of the response
+        """
+        with self._lock:
+            key = (endpoint, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if endpoint not in self.durations:
+                self.durations[endpoint] = [[0] * len(self.BUCKETS), 0.0, 0]
+            histogram = self.durations[endpoint]
+            for i, bound in enumerate(self.BUCKETS):
+                if timings.total <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += timings.total
+            histogram[2] += 1
+            for name, seconds in timings.phases.items():
+                self.phases[name] = self.phases.get(name, 0.0) + seconds
+            self.rows_fetched += timings.rows_fetched
+            self.rows_rendered += timings.rows_rendered
+            self.bytes_out += timings.bytes_out
+
+    def render(self) -> str:
+        """Render the totals in the Prometheus text format.
+
+        :return: metrics text
+        """
+        with self._lock:
+            lines = [
+                "# HELP sprocket_requests_total Number of requests",
+                "# TYPE sprocket_requests_total counter",
+            ]
+            for (endpoint, status), count in sorted(self.requests.items()):
+                lines.append(
+                    f'sprocket_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}'
+                )
+            lines.extend(
+                [
+                    "# HELP sprocket_request_duration_seconds Time to handle a request, until the"
+                    " response was sent",
+                    "# TYPE sprocket_request_duration_seconds histogram",
+                ]
+            )
+            for endpoint, (buckets, total, count) in sorted(self.durations.items()):
+                cumulative = 0
+                for bound, n in zip(self.BUCKETS, buckets):
+                    cumulative += n
+                    lines.append(
+                        "sprocket_request_duration_seconds_bucket"
+                        f'{{endpoint="{endpoint}",le="{bound}"}} {cumulative}'
+                    )
+                lines.extend(
+                    [
+                        "sprocket_request_duration_seconds_bucket"
+                        f'{{endpoint="{endpoint}",le="+Inf"}} {count}',
+                        f'sprocket_request_duration_seconds_sum{{endpoint="{endpoint}"}} {total}',
+                        f'sprocket_request_duration_seconds_count{{endpoint="{endpoint}"}} {count}',
+                    ]
+                )
+            lines.extend(
+                [
+                    "# HELP sprocket_phase_seconds_total Time spent in each phase of requests",
+                    "# TYPE sprocket_phase_seconds_total counter",
+                ]
+            )
+            for name, seconds in sorted(self.phases.items()):
+                lines.append(f'sprocket_phase_seconds_total{{phase="{name}"}} {seconds}')
+            for name, value, text in [
+                ("rows_fetched", self.rows_fetched, "Number of rows fetched from the database"),
+                ("rows_rendered", self.rows_rendered, "Number of rows rendered in responses"),
+                ("response_bytes", self.bytes_out, "Number of bytes sent in responses"),
+            ]:
+                lines.extend(
+                    [
+                        f"# HELP sprocket_{name}_total {text}",
+                        f"# TYPE sprocket_{name}_total counter",
+                        f"sprocket_{name}_total {value}",
+                    ]
+                )
+            return "\n".join(lines) + "\n"
+
+
+class ResponseCache:
+    """Cache for whole responses (rendered HTML pages and exports), so that repeated requests for
+    the same view skip the database and rendering. Responses are only reused while the data
+    version of the database is the same as when they were cached:
+    - SQLite: the modification time and size of the database file (and its write-ahead log)
+    - Postgres: the result of version_query (by default, the current write-ahead log location,
+      which changes whenever any data is written, or the last replayed location on a standby)
+    - other databases (or a SQLite file that cannot be found): responses are only cached when ttl
+      is set, and are then reused for ttl seconds
+
+    The least recently used responses are removed when the total size is larger than max_size."""
+
+    def __init__(
+        self, max_size: int = 64 * 1024 * 1024, ttl: float = None, version_query: str = None
+    ):
+        """
+        :param max_size: max total size in bytes (or characters for HTML) of cached responses.
+                         Responses larger than a quarter of this are not cached.
+        :param ttl: max seconds to reuse a response, even if the data version is the same (None
+                    to reuse responses until the data changes, which disables the cache when the
+                    data version cannot be determined)
+        :param version_query: SQL query that returns a single value that changes whenever the
+                              data changes (default for Postgres: the current or last replayed
+                              write-ahead log location)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version_query = version_query
+        # key -> (data version, expiration time, mimetype, body)
+        self._entries = OrderedDict()  # type: OrderedDict
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """Remove all responses from the cache."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def get(self, key: str, version: Any) -> Optional[Tuple[str, Union[str, bytes]]]:
+        """Get a cached response.
+
+        :param key: request key
+        :param version: current data version (see get_version)
+        :return: (mimetype, body) or None if the response is not cached or is out of date
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            if entry[0] != version or (entry[1] is not None and entry[1] < time.time()):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[2], entry[3]
+
+    def get_version(self, conn: Connection) -> Any:
+        """Get the current data version of the database.
+
+        :param conn: database connection
+        :return: data version (None when it cannot be determined)
+        """
+        url = conn.engine.url
+        version_query = self.version_query
+        if not version_query and url.drivername.startswith("postgres"):
+            # A hot standby has no current WAL location, but its replayed location changes
+            # whenever data is copied from the primary
+            version_query = (
+                "SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() "
+                "ELSE pg_current_wal_lsn() END"
+            )
+        if version_query:
+            try:
+                return conn.execute(version_query).scalar()
+            except SQLAlchemyError as e:
+                # Serve the request without the cache instead of failing it
+                logging.warning(f"Could not get the data version, so responses are not cached: {e}")
+                return None
+        if url.drivername.startswith("sqlite"):
+            version = []
+            for path in [url.database, (url.database or "") + "-wal"]:
+                try:
+                    stat = os.stat(path)
+                    version.append((stat.st_mtime_ns, stat.st_size))
+                except (OSError, TypeError):
+                    version.append(None)
+            if version[0] is None:
+                # The database is in memory or the file cannot be found
+                return None
+            return tuple(version)
+        return None
+
+    def set(self, key: str, version: Any, mimetype: str, body: Union[str, bytes]):
+        """Add a response to the cache.
+
+        :param key: request key
+        :param version: data version when the response was created (see get_version)
+        :param mimetype: mimetype of the response
+        :param body: complete response body
+        """
+        if len(body) > self.max_size // 4:
+            return
+        if version is None and self.ttl is None:
+            # We cannot tell when the response is out of date
+            return
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (version, expires, mimetype, body)
+            self._size += len(body)
+            while self._size > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def wrap(
+        self, key: str, version: Any, mimetype: str, chunks: Iterable[Union[str, bytes]]
+    ) -> Iterator[Union[str, bytes]]:
+        """Yield the chunks of a streamed response, and add the complete response to the cache
+        once all chunks have been sent. Responses that are too large, or that are not sent
+        completely (e.g., the client disconnects), are not cached.
+
+        :param key: request key
+        :param version: data version when the response was created (see get_version)
+        :param mimetype: mimetype of the response
+        :param chunks: chunks of the response body
+        :return: the same chunks
+        """
+        body = []
+        size = 0
+        for chunk in chunks:
+            yield chunk
+            if body is not None:
+                size += len(chunk)
+                body.append(chunk)
+                if size > self.max_size // 4:
+                    # Too large to cache, so stop keeping the chunks
+                    body = None
+        if body is not None:
+            # Chunks are either all strings (text formats) or all bytes (binary formats)
+            if body and isinstance(body[0], bytes):
+                self.set(key, version, mimetype, b"".join(body))
+            else:
+                self.set(key, version, mimetype, "".join(body))
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._size -= len(entry[3])
+
+
+class SchemaCache:
+    """Cache of the tables, columns, column types, and column descriptions of databases, so that
+    catalog queries do not need to run on every request. Entries are stored per database URL and
+    expire after `ttl` seconds (or never, when `ttl` is None).
+
+    When `detect_changes` is True, SQLite databases are checked with PRAGMA schema_version before
+    each lookup, and all entries for a database are dropped as soon as its schema changes. Column
+    descriptions are data in the 'column' table, so changes to them are only picked up when the
+    entries expire or are invalidated."""
+
+    def __init__(self, ttl: Optional[float] = 300, detect_changes: bool = True):
+        self.ttl = ttl
+        self.detect_changes = detect_changes
+        self._entries = {}  # type: Dict[tuple, Tuple[float, Any]]
+        self._versions = {}  # type: Dict[str, Any]
+        self._lock = threading.Lock()
+
+    def get_column_types(self, conn: Connection, table: str) -> Dict[str, str]:
+        """Get the declared SQL type of each column in a table (see get_sql_column_types)."""
+        return dict(
+            self._get(conn, ("column_types", table), lambda: get_sql_column_types(conn, table))
+        )
+
+    def get_columns(self, conn: Connection, table: str) -> List[str]:
+        """Get a list of columns from a table (see get_sql_columns)."""
+        return list(self._get(conn, ("columns", table), lambda: get_sql_columns(conn, table)))
+
+    def get_descriptions(self, conn: Connection, table: str) -> Dict[str, str]:
+        """Get the column descriptions for a table (see get_sql_descriptions)."""
+        return dict(
+            self._get(conn, ("descriptions", table), lambda: get_sql_descriptions(conn, table))
+        )
+
+    def get_tables(self, conn: Connection) -> List[str]:
+        """Get a list of tables from a database (see get_sql_tables)."""
+        return list(self._get(conn, ("tables",), lambda: get_sql_tables(conn)))
+
+    def invalidate(self, conn: Connection = None, table: str = None):
+        """Remove entries from the cache.
+
+        :param conn: only remove entries for the database of this connection (default: all)
+        :param table: only remove the column entries for this table (default: all)
+        """
+        db = str(conn.engine.url) if conn else None
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if db and key[0] != db:
+                    continue
+                if table and (key[1] == "tables" or key[2] != table):
+                    continue
+                del self._entries[key]
+
+    def _get(self, conn: Connection, key: tuple, fetch: Callable[[], Any]) -> Any:
+        db = str(conn.engine.url)
+        if self.detect_changes and db.startswith("sqlite"):
+            version = conn.execute("PRAGMA schema_version").scalar()
+            with self._lock:
+                if self._versions.get(db) != version:
+                    self._versions[db] = version
+                    for k in [k for k in self._entries.keys() if k[0] == db]:
+                        del self._entries[k]
+        key = (db,) + key
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and (self.ttl is None or now - entry[0] < self.ttl):
+            return entry[1]
+        value = fetch()
+        with self._lock:
+            self._entries[key] = (now, value)
+        return value
+
+
+class SlowQueryLog:
+    """Log of the queries that take longer than a threshold, so that we can find which filters
+    need indexes. Each slow query is logged (as a warning) as a line of JSON with the SQL, its bind
+    parameters, the duration, and the query plan from EXPLAIN QUERY PLAN (SQLite) or EXPLAIN
+    (Postgres)."""
+
+    def __init__(self, threshold: float = 1.0, analyze: bool = False):
+        """
+        :param threshold: min seconds for a query to be logged
+        :param analyze: if True, use EXPLAIN (ANALYZE, BUFFERS) for Postgres, which runs the query
+                        again to get the actual times and row counts of each step of the plan
+        """
+        self.threshold = threshold
+        self.analyze = analyze
+
+    def check(self, conn: Connection, query: str, const_dict: dict, seconds: float):
+        """Log a query if it took longer than the threshold.
+
+        :param conn: database connection that ran the query
+        :param query: SQL query string with :key placeholders
+        :param const_dict: dict of placeholder key -> constraint
+        :param seconds: time it took to run the query
+        """
+        if seconds < self.threshold:
+            return
+        entry = {
+            "slow_query_ms": round(seconds * 1000, 2),
+            "sql": query,
+            "params": const_dict,
+            "plan": self.explain(conn, query, const_dict),
+        }
+        logging.warning(json.dumps(entry, default=str))
+
+    def explain(self, conn: Connection, query: str, const_dict: dict) -> List[str]:
+        """Get the query plan of a query, as a list of lines.
+
+        :param conn: database connection to run EXPLAIN with
+        :param query: SQL query string with :key placeholders
+        :param const_dict: dict of placeholder key -> constraint
+        :return: lines of the query plan (empty for databases other than SQLite and Postgres)
+        """
+        dialect = conn.dialect.name
+        try:
+            if dialect == "sqlite":
+                explain = bind_constraints("EXPLAIN QUERY PLAN " + query, const_dict)
+                lines = []
+                # Indent each step of the plan under its parent step
+                depths = {0: -1}
+                for res in conn.execute(explain, const_dict):
+                    depth = depths.get(res["parent"], -1) + 1
+                    depths[res["id"]] = depth
+                    lines.append("  " * depth + res["detail"])
+                return lines
+            if dialect == "postgresql":
+                explain = "EXPLAIN (ANALYZE, BUFFERS) " if self.analyze else "EXPLAIN "
+                explain = bind_constraints(explain + query, const_dict)
+                return [res[0] for res in conn.execute(explain, const_dict)]
+        except Exception as e:
+            return ["EXPLAIN failed: " + str(e)]
+        return []
+
+
 class SprocketError(RuntimeError):
     """Base class for any runtime exceptions thrown in sprocket code."""
+
+
+class Timings:
+    """Timings of the phases of one request (e.g., catalog, query, count, format, render), and the
+    number of rows and bytes that it handled. Phases with the same name are added together. The
+    time of a phase does not include the time of any phase started inside of it, so the phases
+    add up to (at most) the total time of the request."""
+
+    def __init__(self):
+        self.begin = time.perf_counter()
+        # name -> seconds, in the order that the phases were first started
+        self.phases = {}  # type: Dict[str, float]
+        self.rows_fetched = 0
+        self.rows_rendered = 0
+        self.bytes_out = 0
+        # Seconds from the start to the end of the request (see finish)
+        self.total = None  # type: Optional[float]
+        # [name, start time, seconds spent in nested phases] for each started phase
+        self._stack = []  # type: List[list]
+
+    def finish(self):
+        """Set the total time of the request, once the response has been sent."""
+        self.total = time.perf_counter() - self.begin
+
+    def get_server_timing(self) -> str:
+        """Get the value of a Server-Timing header for the phases so far, including the total
+        time since the start of the request.
+
+        :return: Server-Timing header value
+        """
+        entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.phases.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.begin) * 1000:.2f}")
+        return ", ".join(entries)
+
+    def start(self, name: str):
+        """Start a phase, which ends when stop is called (see time_phase).
+
+        :param name: name of the phase
+        """
+        self._stack.append([name, time.perf_counter(), 0.0])
+
+    def stop(self):
+        """Stop the last phase that was started and add its time."""
+        name, start, nested = self._stack.pop()
+        seconds = time.perf_counter() - start
+        self.phases[name] = self.phases.get(name, 0.0) + seconds - nested
+        if self._stack:
+            self._stack[-1][2] += seconds
+
+    def time_iter(self, name: str, items: Iterable) -> Iterator:
+        """Time how long it takes to produce each item of an iterable (e.g., chunks of a streamed
+        response) as a phase, without the time spent between items.
+
+        :param name: name of the phase
+        :param items: iterable to time
+        :return: iterator of the items
+        """
+        items = iter(items)
+        try:
+            while True:
+                self.start(name)
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    self.stop()
+                yield item
+        finally:
+            if hasattr(items, "close"):
+                items.close()
+
+    def to_dict(self) -> dict:
+        """Get the timings as a dict (e.g., for a structured log line), in milliseconds.
+
+        :return: dict of timings
+        """
+        return {
+            "total_ms": round((self.total or 0) * 1000, 2),
+            "phases_ms": {name: round(seconds * 1000, 2) for name, seconds in self.phases.items()},
+            "rows_fetched": self.rows_fetched,
+            "rows_rendered": self.rows_rendered,
+            "bytes_out": self.bytes_out,
+        }
+
+
+# Client used for requests to Swagger endpoints when no other client is provided
+DEFAULT_HTTP_CLIENT = HTTPClient()
@@ -1,28 +1,81 @@
 import csv
 import json
 import logging
+import re
 
-import requests
-
-from copy import deepcopy
-from flask import render_template, Response
-from io import StringIO
-from jinja2 import Environment, PackageLoader
+from flask import Response
+from io import BytesIO, StringIO
+from itertools import chain
+from types import MappingProxyType
+from jinja2 import Environment, FileSystemBytecodeCache, PackageLoader
 from sqlalchemy.engine import Connection
-from sqlalchemy.sql.expression import text as sql_text
+from typing import Iterable, Iterator, List, Union
 from urllib.parse import unquote
 from .lib import (
+    Cell,
+    compile_transform,
+    count_query,
+    CountedRows,
+    decode_cursor,
+    decode_meta,
+    DEFAULT_HTTP_CLIENT,
+    encode_cursor,
     exec_query,
+    get_facets,
+    get_order_by,
+    get_seek_clause,
+    get_sql_column_types,
     get_sql_columns,
+    get_sql_descriptions,
     get_sql_tables,
+    get_swagger_order,
+    get_swagger_url,
     get_urls,
+    get_violation_counts,
+    HTTPClient,
+    LazyList,
     parse_order_by,
     parse_where,
+    ResponseCache,
+    SchemaCache,
+    SlowQueryLog,
     SprocketError,
+    time_phase,
+    Timings,
+    VIOLATION_LEVELS,
 )
 
 loader = PackageLoader("sprocket")
-template_env = Environment(loader=loader)
+try:
+    # Compiled templates are saved in a private temp directory, so new processes (e.g., CGI or
+    # workers) load them instead of compiling the templates again
+    bytecode_cache = FileSystemBytecodeCache()
+except RuntimeError:
+    # There is no safe temp directory to use
+    bytecode_cache = None
+# Environment for all sprocket templates (including the Flask routes). Templates are only loaded
+# once per process, since they do not change while sprocket is running.
+template_env = Environment(loader=loader, auto_reload=False, bytecode_cache=bytecode_cache)
+
+# Formats that can be exported from a table -> mimetype
+EXPORT_FORMATS = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "csv": "text/comma-separated-values",
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+    "tsv": "text/tab-separated-values",
+}
+
+# Declared SQL types that are stored as Arrow integers (whole words only, since e.g. Postgres
+# 'interval' and 'point' contain 'int')
+ARROW_INT_TYPE = re.compile(r"\b(?:tiny|small|medium|big)?int(?:eger|[248])?\b|serial")
+
+# Max number of rows to request at once from a Swagger endpoint for exports
+SWAGGER_PAGE_SIZE = 1000
+
+# Number of rendered template statements to send at once when HTML is streamed
+STREAM_BUFFER_SIZE = 500
 
 FILTER_OPTS = {
     "eq": {"label": "equals"},
@@ -39,12 +92,27 @@ FILTER_OPTS = {
     "not.in": {"label": "not in"},
 }
 
+# Filter options for each selected operator (None when no filter is set) -> read-only options for
+# the header filter modal, shared by all headers and requests
+SELECTED_FILTER_OPTS = MappingProxyType(
+    {
+        selected: MappingProxyType(
+            {
+                opt: MappingProxyType(dict(details, selected=True) if opt == selected else details)
+                for opt, details in FILTER_OPTS.items()
+            }
+        )
+        for selected in [None] + list(FILTER_OPTS.keys())
+    }
+)
+
 
 def render_database_table(
     conn: Connection,
     table: str,
     request_args: dict,
     base_url: str = None,
+    count_cache: ResponseCache = None,
     default_limit: int = 100,
     display_messages: dict = None,
     edit_link: str = None,
@@ -52,19 +120,33 @@ def render_database_table(
     ignore_cols: list = None,
     ignore_params: list = None,
     javascript: bool = True,
+    json_meta: bool = False,
+    keyset: bool = False,
     primary_key: str = None,
+    response_cache: ResponseCache = None,
+    schema_cache: SchemaCache = None,
     show_help: bool = False,
+    slow_query_log: SlowQueryLog = None,
     standalone: bool = True,
+    stream_html: bool = False,
+    summary_url: str = None,
+    timings: Timings = None,
     transform: dict = None,
     use_view: bool = False,
+    violation_index: bool = False,
 ):
     """Get the SQL table for the Flask app. Either return the rendered HTML or a Response object
     containing TSV/CSV. Utilizes Flask request_args to construct the query to return results.
+    TSV/CSV rows are streamed from the database as the Response is sent, so the connection must
+    stay open until the Response is closed (see Response.call_on_close).
     :param conn: database connection
     :param table: table name
     :param request_args: dict of HTTP request args (Flask request.args)
     :param base_url: The base URL for this page without query parameters. By default, this is the
                      table name. It is used to construct navigation & export links.
+    :param count_cache: ResponseCache to keep the total number of results for each table and set
+                        of filters in, so that turning pages (e.g., with keyset) does not count
+                        all the results again until the data changes.
     :param default_limit: The max number of results to show per page, unless 'limit' is provided in
                           the query parameters.
     :param display_messages: dictionary containing messages to display as dismissible banners. The
@@ -80,31 +162,90 @@ def render_database_table(
     :param ignore_cols: list of columns of the SQL table to exclude from query/results.
     :param ignore_params: list of query parameters to exclude from URL.
     :param javascript: if True, include sprocket javascript in the HTML output.
+    :param json_meta: if True, use the JSON functions of the database (SQLite JSON1 or Postgres
+                      jsonb) to filter violations, and to skip the *_meta JSON of valid cells
+                      for HTML tables.
+    :param keyset: if True, use keyset (seek) pagination for the HTML table. The navigation links
+                   include a cursor with the values of the ORDER BY columns for the first or last
+                   row of the page, so that the database can seek directly to the next page instead
+                   of scanning all skipped rows. This requires either primary_key or a
+                   'row_number' column to break ties.
     :param primary_key: The column name to use as the primary key for the table. This value will be
                         included as a hidden td in each table row with the HTML ID of pk{row_num}.
+    :param response_cache: ResponseCache to reuse rendered pages and exports from while the data
+                           has not changed
+    :param schema_cache: SchemaCache to get tables, columns, and descriptions from instead of
+                         querying the database catalog on every call.
     :param show_help: if True, show descriptions for columns in single-row view.
                       This requires the 'column' table in the database.
+    :param slow_query_log: SlowQueryLog to log the queries for the table to if they are slow
     :param standalone: if True, include HTML headers & script in HTML output.
-    :param transform: dict of column name -> "transform" function (as a string that is evaluated)
-                      to apply to all cells in the column. Only builtin python methods should be
-                      used in the function. Literal strings should be encased in quotes within the
-                      string to ensure `eval` does not throw a SyntaxError.
+    :param stream_html: if True, return HTML as a streamed Response, so that the start of the page
+                        is sent before all rows are rendered
+    :param summary_url: URL of the summary of the table (see render_summary). If included, the
+                        violation counts and most common values of each column are requested
+                        from this URL and shown in the column menus of the HTML table.
+    :param timings: Timings of the request to add the time of each phase (cache, catalog, query,
+                    count, format, render, export) and the number of rows to
+    :param transform: dict of column name -> "transform" expression (as a string of Python code)
+                      to apply to all cells in the column, where {column} is the cell value (see
+                      compile_transform). Only builtin python methods can be used in the
+                      expression. A placeholder encased in quotes is the value as a string.
     :param use_view: if True, attempt to retrieve results from a '*_view' table which combines the
-                     table and its conflict table. TODO: reference VALVE2"""
-    tables = get_sql_tables(conn)
-    if table not in tables:
-        raise SprocketError(f"'{table}' is not a valid table in the database")
-    table_cols = get_sql_columns(conn, table)
-
-    descriptions = {}
-    if show_help and "column" in tables:
-        query = sql_text(
-            """SELECT "column", description FROM "column"
-               WHERE "table" = :table AND description IS NOT NULL"""
+                     table and its conflict table. TODO: reference VALVE2
+    :param violation_index: if True, filter violations using the violation index for the table
+                            (or view) instead of the *_meta columns. The index must be built first
+                            with build_violation_index."""
+    if response_cache:
+        # Requests with the same args (in any order) and options get the same response
+        cache_key = repr(
+            (
+                table,
+                sorted(request_args.items()),
+                base_url,
+                default_limit,
+                display_messages,
+                edit_link,
+                hide_meta,
+                ignore_cols,
+                ignore_params,
+                javascript,
+                keyset,
+                primary_key,
+                show_help,
+                standalone,
+                summary_url,
+                sorted((transform or {}).items()),
+                use_view,
+            )
         )
-        results = conn.execute(query, table=table)
-        for res in results:
-            descriptions[res["column"]] = res["description"]
+        with time_phase(timings, "cache"):
+            version = response_cache.get_version(conn)
+            cached = response_cache.get(cache_key, version)
+        if cached:
+            mimetype, body = cached
+            if mimetype == "text/html" and not stream_html:
+                return body
+            return Response(body, mimetype=mimetype)
+
+    with time_phase(timings, "catalog"):
+        if schema_cache:
+            tables = schema_cache.get_tables(conn)
+        else:
+            tables = get_sql_tables(conn)
+        if table not in tables:
+            raise SprocketError(f"'{table}' is not a valid table in the database")
+        if schema_cache:
+            table_cols = schema_cache.get_columns(conn, table)
+        else:
+            table_cols = get_sql_columns(conn, table)
+
+        descriptions = {}
+        if show_help and "column" in tables:
+            if schema_cache:
+                descriptions = schema_cache.get_descriptions(conn, table)
+            else:
+                descriptions = get_sql_descriptions(conn, table)
 
     # Parse request_args to set options
     # limit: how many results to display per page
@@ -121,12 +262,16 @@ def render_database_table(
     except ValueError:
         raise SprocketError(f"'offset' ({offset}) must be an integer")
 
-    limit = limit + offset
-
     # fmt: return format (TSV & CSV will prompt downloads)
     fmt = request_args.get("format", "html")
-    if fmt not in ["tsv", "csv", "html"]:
-        raise SprocketError(f"'format' must be 'tsv', 'csv', or 'html', not '{fmt}'")
+    if fmt not in EXPORT_FORMATS and fmt != "html":
+        raise SprocketError(
+            "'format' must be 'tsv', 'csv', 'json', 'ndjson', 'arrow', 'parquet', or 'html', "
+            f"not '{fmt}'"
+        )
+
+    # expand_meta: for JSON & NDJSON, include *_meta columns as objects instead of strings
+    expand_meta = request_args.get("expand_meta", "false").lower() == "true"
 
     # select: which columns to display, excluding any ignore_cols
     select = request_args.get("select")
@@ -164,21 +309,45 @@ def render_database_table(
 
     # order: sort the results by one or more columns + optional keywords (asc/desc, nulls order),
     #        separated by commas - modeled on https://postgrest.org/en/latest/api.html#ordering
-    order_by = []
+    order_keys = []
     order = request_args.get("order")
     if order:
         try:
-            order_by = []
-            for ob in parse_order_by(order):
-                s = [f'"{ob["key"]}"']
-                if ob["order"]:
-                    s.append(ob["order"].upper())
-                if ob["nulls"]:
-                    s.append("NULLS " + ob["nulls"].upper())
-                order_by.append(" ".join(s))
+            order_keys = parse_order_by(order)
         except ValueError as e:
             return SprocketError(e)
 
+    # after/before: keyset pagination cursors, used instead of offset when keyset is True
+    seek = None
+    reverse = False
+    key_col = primary_key or ("row_number" if "row_number" in table_cols else None)
+    if keyset and key_col:
+        # The last column must be unique so that every row has a distinct position
+        keyset_keys = []
+        for ob in order_keys:
+            keyset_keys.append(ob)
+            if ob["key"] == key_col:
+                break
+        else:
+            keyset_keys.append({"key": key_col, "order": "asc", "nulls": "last"})
+        order_keys = keyset_keys
+        after = request_args.get("after")
+        before = request_args.get("before")
+        if after:
+            cursor = decode_cursor(after)
+            if len(cursor) == len(keyset_keys):
+                seek = get_seek_clause(keyset_keys, cursor)
+        elif before == "last":
+            reverse = True
+        elif before:
+            cursor = decode_cursor(before)
+            if len(cursor) == len(keyset_keys):
+                seek = get_seek_clause(keyset_keys, cursor, reverse=True)
+                reverse = True
+    else:
+        keyset = False
+    order_by = get_order_by(order_keys, reverse=reverse)
+
     # violations: when using "meta" columns, filter the results based on one or more violation
     #             level, separated by commas
     # TODO: include reference to VALVE2 tool
@@ -186,7 +355,7 @@ def render_database_table(
     if violations:
         violations = violations.split(",")
         for v in violations:
-            if v not in ["debug", "info", "warn", "error"]:
+            if v not in VIOLATION_LEVELS:
                 return SprocketError(
                     f"'violations' contains invalid level '{v}' - "
                     "must be one of: debug, info, warn, error",
@@ -195,33 +364,90 @@ def render_database_table(
     # Build & execute the query
     if primary_key and fmt == "html" and primary_key not in select_cols:
         # We always need the primary key, even if it's hidden from select query param
-        query_cols = deepcopy(select_cols)
-        query_cols.insert(0, primary_key)
+        query_cols = [primary_key] + select_cols
     else:
-        query_cols = deepcopy(select_cols)
-    if "row_number" in table_cols:
+        query_cols = list(select_cols)
+    if "row_number" in table_cols and "row_number" not in query_cols:
         query_cols.insert(0, "row_number")
+    if keyset and fmt == "html":
+        # We need the values of all keyset columns to create the cursors
+        query_cols.extend([x["key"] for x in order_keys if x["key"] not in query_cols])
     tname = table
     if use_view:
         tname += "_view"
-    results = exec_query(
-        conn,
-        tname,
-        columns=table_cols,
-        select=query_cols,
-        where_statements=where_statements,
-        order_by=order_by,
-        violations=violations,
-    )
+
+    def get_results(offset: int):
+        return exec_query(
+            conn,
+            tname,
+            columns=table_cols,
+            select=query_cols,
+            where_statements=where_statements,
+            order_by=order_by,
+            violations=violations,
+            limit=limit,
+            offset=offset if not seek and not reverse else 0,
+            seek=seek,
+            # Exports are streamed, unless the rows must be reversed first
+            stream=fmt != "html" and not reverse,
+            # The violation index is built for the table, not its view
+            index_table=table if violation_index else None,
+            json_meta=json_meta,
+            # The HTML table only needs the JSON of cells that are not valid or are null
+            full_meta=fmt != "html" or not hide_meta,
+            timings=timings,
+            slow_query_log=slow_query_log,
+        )
+
+    results = get_results(offset)
+    if reverse:
+        # Results were retrieved backwards from the cursor
+        results.reverse()
 
     # Return results based on format
     if fmt == "html":
-        return render_html_table(
+        with time_phase(timings, "count"):
+            total = None
+            if count_cache:
+                # The count does not depend on the order, page, or selected columns
+                count_key = repr(("count", tname, where_statements, violations))
+                count_version = count_cache.get_version(conn)
+                cached = count_cache.get(count_key, count_version)
+                if cached:
+                    total = int(cached[1])
+            if total is None:
+                total = count_query(
+                    conn,
+                    tname,
+                    columns=table_cols,
+                    where_statements=where_statements,
+                    violations=violations,
+                    index_table=table if violation_index else None,
+                    json_meta=json_meta,
+                    slow_query_log=slow_query_log,
+                )
+                if count_cache:
+                    count_cache.set(count_key, count_version, "text/plain", str(total))
+        if offset and not results and 0 < total <= offset and not seek and not reverse:
+            # The offset is past the end of the results (e.g., a filter was added on a later
+            # page), so show the first page instead
+            offset = 0
+            request_args = request_args.copy()
+            request_args["offset"] = "0"
+            results = get_results(offset)
+        cursors = None
+        if keyset and results:
+            cursors = {
+                "prev": encode_cursor([results[0][x["key"]] for x in order_keys]),
+                "next": encode_cursor([results[-1][x["key"]] for x in order_keys]),
+            }
+        html = render_html_table(
             results,
             table,
             request_args,
             base_url=base_url,
             columns=select_cols,
+            cursors=cursors,
             default_limit=default_limit,
             descriptions=descriptions,
             display_messages=display_messages,
@@ -230,19 +456,42 @@ def render_database_table(
             javascript=javascript,
             primary_key=primary_key,
             standalone=standalone,
+            stream_html=stream_html,
+            summary_url=summary_url,
+            timings=timings,
+            total=total,
             transform=transform,
         )
-    headers = results[0].keys()
-    output = StringIO()
-    sep = "\t"
-    mt = "text/tab-separated-values"
-    if fmt == "csv":
-        sep = ","
-        mt = "text/comma-separated-values"
-    writer = csv.writer(output, delimiter=sep, lineterminator="\n")
-    writer.writerow(list(headers))
-    writer.writerows(list(results)[offset : limit + offset])
-    return Response(output.getvalue(), mimetype=mt)
+        if stream_html:
+            if response_cache:
+                html = response_cache.wrap(cache_key, version, "text/html", html)
+            return Response(html, mimetype="text/html")
+        if response_cache:
+            response_cache.set(cache_key, version, "text/html", html)
+        return html
+    if timings:
+        # Exported rows are sent as they are fetched
+        if isinstance(results, CountedRows):
+            results.rendered = True
+        else:
+            timings.rows_rendered += len(results)
+    if fmt in ["arrow", "parquet"]:
+        with time_phase(timings, "catalog"):
+            if schema_cache:
+                column_types = schema_cache.get_column_types(conn, table)
+            else:
+                column_types = get_sql_column_types(conn, table)
+        types = [column_types.get(c, "") for c in query_cols]
+        output = stream_arrow_table(query_cols, types, results, fmt=fmt)
+    elif fmt in ["json", "ndjson"]:
+        output = stream_json_table(query_cols, results, fmt=fmt, expand_meta=expand_meta)
+    else:
+        output = stream_tsv_table(query_cols, results, fmt=fmt)
+    if timings:
+        output = timings.time_iter("export", output)
+    if response_cache:
+        output = response_cache.wrap(cache_key, version, EXPORT_FORMATS[fmt], output)
+    return Response(output, mimetype=EXPORT_FORMATS[fmt])
 
 
 def render_html_table(
@@ -252,6 +501,7 @@ def render_html_table(
     base_url: str = None,
     columns: list = None,
     conflict_prefix: str = "row/",
+    cursors: dict = None,
     default_limit: int = 100,
     descriptions: dict = None,
     display_messages: dict = None,
@@ -262,9 +512,12 @@ def render_html_table(
     primary_key: str = None,
     show_filters: bool = True,
     standalone: bool = True,
+    stream_html: bool = False,
+    summary_url: str = None,
+    timings: Timings = None,
     total: int = None,
     transform: dict = None,
-) -> str:
+) -> Union[str, Iterator[str]]:
     """Render the data as an HTML table.
 
     :param data: SQL query results as list of dicts
@@ -276,6 +529,8 @@ def render_html_table(
                     If not provided, the keys of the first element of data are used as headers.
     :param conflict_prefix: Prefix to use for row_number when primary_key is provided and there is a
                             primary_key conflict, e.g. row/32. TODO: reference VALVE2
+    :param cursors: keyset pagination cursors for the "prev" and "next" pages (see get_urls). If
+                    not provided, the navigation links use offset.
     :param default_limit: the max number of rows to display on a single page, by default. This is
                           overriden by the `limit` param in `request_args`.
     :param descriptions: dict of column name to description to display tooltips in single-row view.
@@ -293,14 +548,21 @@ def render_html_table(
                         included as a hidden td in each table row with the HTML ID of pk{row_num}.
     :param show_filters: if True, show "filter by condition" options in header modals.
     :param standalone: if True, do not include HTML headers.
+    :param stream_html: if True, return an iterator of HTML chunks that renders the template as it
+                        is consumed (e.g., by a streamed Response), instead of a string
+    :param summary_url: URL of the summary of the table (see render_summary) to show in the column
+                        menus of the HTML table
+    :param timings: Timings of the request to add the time to format the rows (decoding meta
+                    columns & applying transforms, as 'format') and to render the template (as
+                    'render') to, and the number of rows rendered
     :param total: if only a subset of the total results is passed to the render function, `total`
                   must be specified to display the correct number of total results in the pagination
                   bars. If not specified, the total will be the length of `data`
-    :param transform: dict of column name -> "transform" function (as a string that is evaluated)
-                      to apply to all cells in the column. Only builtin python methods should be
-                      used in the function. Literal strings should be encased in quotes within the
-                      string to ensure `eval` does not throw a SyntaxError.
-    :return: HTML string
+    :param transform: dict of column name -> "transform" expression (as a string of Python code)
+                      to apply to all cells in the column, where {column} is the cell value (see
+                      compile_transform). Only builtin python methods can be used in the
+                      expression. A placeholder encased in quotes is the value as a string.
+    :return: HTML string, or iterator of HTML strings when stream_html is True
     """
     if columns:
         header_names = columns
@@ -313,126 +575,93 @@ def render_html_table(
         if "*" not in select_cols:
             header_names = select_cols
 
-    # Clean up null values and add styles
-    results = []
-    for res in data:
-        values = {}
-        for k, v in res.items():
-            style = None
-            if v is None or (not isinstance(v, int) and not v):
-                v = ""
-                style = "null"
-            display = v
-            if transform and k in transform:
-                display = transform[k].format(**{k: v})
-                try:
-                    display = eval(display)
-                except SyntaxError:
-                    raise SprocketError("Unable to eval transformation: " + v)
-            values[k] = {
-                "display": str(display),
-                "value": v,
-                "style": style,
-                "message": None,
-                "header": k,
-            }
-        results.append(values)
+    offset = int(request_args.get("offset", "0"))
+    limit = int(request_args.get("limit", default_limit))
+
+    if total is None:
+        # Only format the rows that are displayed
+        total = len(data)
+        if total < offset:
+            offset = 0
+        data = data[offset : limit + offset]
 
-    if hide_meta and results:
+    # Compile the transform expressions before formatting any cells
+    transforms = {}
+    if transform:
+        transforms = {k: compile_transform(k, expr) for k, expr in transform.items()}
+
+    meta_names = []
+    if hide_meta and data:
         # exclude *_meta columns from display and use the values to render cell styles
-        meta_names = [x for x in results[0].keys() if x.endswith("_meta")]
+        meta_names = [x for x in data[0].keys() if x.endswith("_meta")]
         header_names = [x for x in header_names if x not in meta_names]
         # also update columns for selections
         if columns:
             columns = [x for x in columns if not x.endswith("_meta")]
-        # iter through results and update
-        res_updated = []
-        for res in results:
-            for m in meta_names:
-                # Get the metadata as JSON
-                meta = res[m]["value"]
-                del res[m]
-                if not meta:
-                    continue
-                metadata = json.loads(meta)
-
-                if metadata.get("valid") and not metadata.get("nulltype"):
-                    # Cell is not a null & is valid, nothing to style or change
-                    continue
-
-                # This is the name of the column we are editing
-                value_col = m[:-5]
-                # Set the value to what is given in the JSON (as "value")
-                # unless there is a primary key conflict, in which case use conflict format
-                pk_value = None
-                if primary_key and value_col == primary_key and "row_number" in res:
-                    # Determine if the there is a conflict
-                    for msg in metadata["messages"]:
-                        if msg["rule"] == "key:primary":
-                            pk_value = f"{conflict_prefix}{res['row_number']['value']}"
-                if not pk_value:
-                    pk_value = metadata["value"]
-                res[value_col]["conflict_key"] = pk_value
-                res[value_col]["display"] = metadata["value"]
-                if "nulltype" in metadata:
-                    # Set null style and go to next
-                    res[value_col]["style"] = "null"
-                    continue
-
-                # Use a number for violation level to make sure the "worst" violation is displayed
-                violation_level = -1
-                messages = []
-                if "messages" in metadata:
-                    for msg in metadata["messages"]:
-                        lvl = msg["level"]
-                        messages.append(msg["message"])
-                        if lvl == "error":
-                            violation_level = 3
-                        elif lvl == "warn" and violation_level < 3:
-                            violation_level = 2
-                        elif lvl == "info" and violation_level < 2:
-                            violation_level = 1
-                        elif lvl == "debug" and violation_level < 1:
-                            violation_level = 0
-
-                # Set cell style based on violation level
-                if violation_level == 0:
-                    res[value_col]["style"] = "debug"
-                elif violation_level == 1:
-                    res[value_col]["style"] = "info"
-                elif violation_level == 2:
-                    res[value_col]["style"] = "warn"
-                elif violation_level == 3:
-                    res[value_col]["style"] = "error"
-
-                # Join multiple messages with line breaks
-                if len(messages) > 1:
-                    messages = [f"({i}) {msg}" for i, msg in enumerate(messages, 1)]
-                res[value_col]["message"] = "<br>".join(messages).replace('"', "&quot;")
-            res_updated.append(res)
-        results = res_updated
     elif hide_meta:
         header_names = [x for x in header_names if not x.endswith("_meta")]
 
-    offset = int(request_args.get("offset", "0"))
-    limit = int(request_args.get("limit", default_limit))
+    def format_row(res: dict) -> dict:
+        # Clean up null values and add styles
+        values = {}
+        for k, v in res.items():
+            style = None
+            if v is None or (not isinstance(v, int) and not v):
+                v = ""
+                style = "null"
+            display = v
+            if k in transforms:
+                display = transforms[k](v)
+            values[k] = Cell(k, v, str(display), style)
 
-    if not total:
-        total = len(results)
-        if total < offset:
-            offset = 0
-        results = list(results)[offset : limit + offset]
+        for m in meta_names:
+            meta = values.pop(m).value
+            if not meta:
+                continue
+            details = decode_meta(meta)
+            if not details:
+                # Cell is not a null & is valid, nothing to style or change
+                continue
+
+            # This is the name of the column we are editing
+            value_col = m[:-5]
+            cell = values[value_col]
+            # Set the value to what is given in the JSON (as "value")
+            # unless there is a primary key conflict, in which case use conflict format
+            if (
+                details["conflict"]
+                and primary_key
+                and value_col == primary_key
+                and "row_number" in values
+            ):
+                cell.conflict_key = f"{conflict_prefix}{values['row_number'].value}"
+            else:
+                cell.conflict_key = details["value"]
+            cell.display = details["value"]
+            if details["style"]:
+                cell.style = details["style"]
+            if details["message"] is not None:
+                cell.message = details["message"]
+        return values
+
+    if timings:
+        untimed_format_row = format_row
+
+        def format_row(res: dict) -> dict:
+            timings.start("format")
+            try:
+                return untimed_format_row(res)
+            finally:
+                timings.stop()
+                timings.rows_rendered += 1
 
     # Set the options for filtering - only if we're showing options
     headers = {}
     for h in header_names:
         fltr = request_args.get(h)
         if not fltr:
-            cur_options = deepcopy(FILTER_OPTS)
-            cur_options["ilike"]["selected"] = True
-            headers[h] = {"options": cur_options}
+            headers[h] = {"options": SELECTED_FILTER_OPTS["ilike"]}
             continue
-        cur_options = deepcopy(FILTER_OPTS)
         # Make sure to split correctly in case constraint has a dot
         # The only time the filter has two dots is when not is used
         if fltr.startswith("not"):
@@ -441,8 +670,9 @@ def render_html_table(
         else:
             opt = fltr.split(".", 1)[0]
             val = fltr.split(".", 1)[1]
-        cur_options[opt]["selected"] = True
-        headers[h] = {"options": cur_options, "const": val}
+        # Unknown operators are shown without a selected option
+        options = SELECTED_FILTER_OPTS.get(opt, SELECTED_FILTER_OPTS[None])
+        headers[h] = {"options": options, "const": val}
 
     # Set the options for violation filtering
     violations = request_args.get("violations", "").split(",")
@@ -450,7 +680,13 @@ def render_html_table(
     if not base_url:
         base_url = "./" + table
     urls = get_urls(
-        base_url, request_args, total, ignore_params=ignore_params, offset=offset, limit=limit
+        base_url,
+        request_args,
+        total,
+        ignore_params=ignore_params,
+        offset=offset,
+        limit=limit,
+        cursors=cursors,
     )
 
     # Get the columns we're sorting by and put into appropriate list so we know which btn to show
@@ -476,43 +712,125 @@ def render_html_table(
         "sort_asc": sort_asc,
         "sort_desc": sort_desc,
         "standalone": standalone,
+        "summary_url": summary_url,
         "title": table,
         "total": total,
         "urls": urls,
         "violations": violations,
     }
-    if limit == 1 or total == 1:
+    if (limit == 1 or total == 1) and data:
         render_args["descriptions"] = descriptions
-        render_args["row"] = results[0]
+        render_args["row"] = format_row(data[0])
         template = "vertical.html"
     else:
-        # Create the row to pass to template, to know what to display (hidden vs visible)
-        display_rows = []
-        for row in results:
+
+        def format_display_row(res: dict) -> dict:
+            # Create the row to pass to template, to know what to display (hidden vs visible)
+            row = format_row(res)
             # Find the values, maybe delete the item if it shouldn't be included in display
             if primary_key:
                 # Key value is either the conflict key or just the value of the primary key col
-                key_val = row[primary_key].get("conflict_key", row[primary_key]["value"])
+                key_cell = row[primary_key]
+                if key_cell.conflict_key is not None:
+                    key_val = key_cell.conflict_key
+                else:
+                    key_val = key_cell.value
                 if primary_key not in header_names:
                     del row[primary_key]
                     if primary_key + "_meta" in row:
                         del row[primary_key + "_meta"]
             else:
                 key_val = None
-            display_rows.append({"cells": row, "row_key": key_val})
+            return {"cells": row, "row_key": key_val}
+
         template = "horizontal.html"
-        render_args["rows"] = display_rows
+        # Rows are formatted as the template is rendered, so they are never all kept in memory
+        render_args["rows"] = LazyList(data, format_display_row)
     t = template_env.get_template(template)
-    return t.render(**render_args)
+    if stream_html:
+        # Send the output in chunks of rendered template statements instead of one at a time
+        stream = t.stream(**render_args)
+        stream.enable_buffering(STREAM_BUFFER_SIZE)
+        if timings:
+            return timings.time_iter("render", stream)
+        return stream
+    with time_phase(timings, "render"):
+        return t.render(**render_args)
+
+
+def render_summary(
+    conn: Connection,
+    table: str,
+    facet_limit: int = 10,
+    json_meta: bool = False,
+    response_cache: ResponseCache = None,
+    schema_cache: SchemaCache = None,
+    timings: Timings = None,
+    violation_index: bool = False,
+) -> Response:
+    """Get a JSON summary of a table, with the number of cells with messages at each violation
+    level in each column that has a *_meta column, and the most common values (facets) of each
+    column. The summary is computed with aggregate queries over the whole table, so it should be
+    cached with a response_cache that is cleared when the data changes.
+
+    :param conn: database connection
+    :param table: table name
+    :param facet_limit: max number of values to include for each column
+    :param json_meta: if True, use the JSON functions of the database to count violations
+    :param response_cache: ResponseCache to reuse the summary from while the data has not changed
+    :param schema_cache: SchemaCache to get tables & columns from
+    :param timings: Timings of the request to add the time of each phase (cache, catalog, summary)
+    :param violation_index: if True, count violations with the violation index for the table
+    :return: Response containing JSON {"table": table, "columns": {column: {"facets": [...],
+             "violations": {level: count}}}}
+    """
+    if response_cache:
+        cache_key = repr(("summary", table, facet_limit, json_meta, violation_index))
+        with time_phase(timings, "cache"):
+            version = response_cache.get_version(conn)
+            cached = response_cache.get(cache_key, version)
+        if cached:
+            mimetype, body = cached
+            return Response(body, mimetype=mimetype)
+
+    with time_phase(timings, "catalog"):
+        if schema_cache:
+            tables = schema_cache.get_tables(conn)
+        else:
+            tables = get_sql_tables(conn)
+        if table not in tables:
+            raise SprocketError(f"'{table}' is not a valid table in the database")
+        if schema_cache:
+            table_cols = schema_cache.get_columns(conn, table)
+        else:
+            table_cols = get_sql_columns(conn, table)
+
+    columns = [x for x in table_cols if not x.endswith("_meta") and x != "row_number"]
+    with time_phase(timings, "summary"):
+        facets = get_facets(conn, table, columns, limit=facet_limit)
+        counts = get_violation_counts(
+            conn, table, table_cols, json_meta=json_meta, violation_index=violation_index
+        )
+    summary = {col: {"facets": facets[col]} for col in columns}
+    for col, levels in counts.items():
+        if col in summary:
+            summary[col]["violations"] = levels
+    body = json.dumps({"table": table, "columns": summary}, default=str)
+    if response_cache:
+        response_cache.set(cache_key, version, "application/json", body)
+    return Response(body, mimetype="application/json")
 
 
 def render_swagger_table(
     swagger_url: str,
     table: str,
     request_args: dict,
+    client: HTTPClient = None,
     default_limit: int = 100,
     javascript: bool = True,
     standalone: bool = True,
+    stream_html: bool = False,
+    timings: Timings = None,
 ):
     """Get the SQL table for the Flask app from a Swagger endpoint. Either return the rendered HTML
     or a Response object containing TSV/CSV. Uses query parameters (request_args) to construct query
@@ -521,43 +839,55 @@ def render_swagger_table(
     :param swagger_url: URL to remote database (Swagger)
     :param table: table name
     :param request_args: dict of HTTP request args (Flask request.args)
+    :param client: HTTPClient to send requests with (default: DEFAULT_HTTP_CLIENT)
     :param default_limit: if limit parameter is not provided, default number of results to show
     :param javascript: if True, include sprocket Javascript at bottom of HTML output
     :param standalone: if True, include HTML headers & script in HTML output.
+    :param stream_html: if True, return HTML as a streamed Response, so that the start of the page
+                        is sent before all rows are rendered
+    :param timings: Timings of the request to add the time of each phase (fetch, format, render,
+                    export) and the number of rows to
     :return: rendered HTML or Response containing table to download
     """
-    # Create a URL to get JSON from
-    url = swagger_url + "/" + table
-    swagger_request_args = []
-
     # Parse args and create request
-    fmt = None
-    has_limit = False
-    for arg, value in request_args.items():
-        if arg == "limit":
-            # Overrides the default_limit
-            has_limit = True
-        if arg == "violations":
-            # Not supported by endpoint
-            logging.info(
-                "'violations' is not a valid parameter for Swagger endpoint and will be ignored"
-            )
-            continue
-        if arg == "format":
-            # We handle the format later
-            fmt = value
-            continue
-        swagger_request_args.append(f"{arg}={value}")
-    if not has_limit:
-        # We always want to have the limit
-        swagger_request_args.append(f"limit={default_limit}")
-
-    # Send request and get data + total rows
-    if swagger_request_args:
-        url += "?" + "&".join(swagger_request_args)
-    r = requests.get(url, verify=False, headers={"Prefer": "count=estimated"})
-    data = r.json()
-    total = int(r.headers["Content-Range"].split("/")[1])
+    fmt = request_args.get("format")
+    expand_meta = request_args.get("expand_meta", "").lower() == "true"
+    if "violations" in request_args:
+        # Not supported by endpoint
+        logging.info(
+            "'violations' is not a valid parameter for Swagger endpoint and will be ignored"
+        )
+    try:
+        offset = int(request_args.get("offset", "0"))
+        limit = int(request_args.get("limit", default_limit))
+    except ValueError:
+        # Let the endpoint return the error
+        offset = limit = None
+    client = client or DEFAULT_HTTP_CLIENT
+
+    if fmt and limit is not None:
+        # Exports are requested from the endpoint and streamed one page at a time
+        page_args = request_args
+        if "order" not in request_args:
+            # Without an order, the endpoint may return rows in a different order for each page
+            order = get_swagger_order(swagger_url, table, client=client)
+            if not order:
+                raise SprocketError(
+                    f"The columns of '{table}' are not described by the endpoint, "
+                    "so 'order' is required to export it"
+                )
+            page_args = dict(request_args, order=order)
+        pages = iter_swagger_pages(client, swagger_url, table, page_args, offset, limit)
+        if timings:
+            pages = timings.time_iter("fetch", pages)
+        data = next(pages, [])
+    else:
+        # Send request and get data + total rows
+        url = get_swagger_url(swagger_url, table, request_args, default_limit=default_limit)
+        with time_phase(timings, "fetch"):
+            r = client.get(url, headers={"Prefer": "count=estimated"})
+            data = r.json()
+        pages = iter([])
 
     # Error from API
     if type(data) == dict:
@@ -567,29 +897,56 @@ def render_swagger_table(
         else:
             msg = "Unable to complete query"
             details = "Please revise query and try again."
-        return render_template(
-            "test.html",
+        return template_env.get_template("base.html").render(
             title=table,
             default=f"<div class='container'><h2>{msg}</h2><p>{details}</p></div>",
+            standalone=standalone,
         )
 
     if fmt:
-        # Save to TSV or CSV, just returning that response
-        mt = "tab-separated-values"
-        if fmt == "csv":
-            mt = "comma-separated-values"
-        output = render_tsv_table(data, fmt=fmt)
+        headers = list(data[0].keys()) if data else []
+        if timings:
+            pages = count_swagger_rows(chain([data], pages), timings)
+        else:
+            pages = chain([data], pages)
+        rows = ([row.get(h) for h in headers] for page in pages for row in page)
+        if fmt in ["json", "ndjson"]:
+            output = stream_json_table(headers, rows, fmt=fmt, expand_meta=expand_meta)
+            mt = EXPORT_FORMATS[fmt]
+        else:
+            # Save to TSV or CSV, just returning that response
+            output = stream_tsv_table(headers, rows, fmt=fmt)
+            mt = EXPORT_FORMATS["tsv"]
+            if fmt == "csv":
+                mt = EXPORT_FORMATS["csv"]
+        if timings:
+            output = timings.time_iter("export", output)
         return Response(output, mimetype=mt)
 
-    return render_html_table(
+    if timings:
+        timings.rows_fetched += len(data)
+    total = int(r.headers["Content-Range"].split("/")[1])
+    if limit and offset + limit < total:
+        # Fetch the next page in the background, using the same args as the "next" link
+        next_args = request_args.copy()
+        next_args["offset"] = offset + limit
+        next_url = get_swagger_url(swagger_url, table, next_args, default_limit=default_limit)
+        client.prefetch(next_url, headers={"Prefer": "count=estimated"})
+
+    html = render_html_table(
         data,
         table,
         request_args,
         default_limit=default_limit,
         javascript=javascript,
         standalone=standalone,
+        stream_html=stream_html,
+        timings=timings,
         total=total,
     )
+    if stream_html:
+        return Response(html, mimetype="text/html")
+    return html
 
 
 def render_tsv_table(data: list, fmt: str = "tsv") -> str:
@@ -599,12 +956,284 @@ def render_tsv_table(data: list, fmt: str = "tsv") -> str:
     :param fmt: table format (tsv or csv)
     :return: string table output
     """
-    headers = data[0].keys()
+    headers = list(data[0].keys())
+    return "".join(stream_tsv_table(headers, ([row.get(h) for h in headers] for row in data), fmt))
+
+
+def count_swagger_rows(pages: Iterable[list], timings: Timings) -> Iterator[list]:
+    """Count the rows of each page from a Swagger endpoint in the timings of a request, as rows
+    that are fetched and rendered (for exports, which send rows as they are fetched).
+
+    :param pages: iterable of pages of rows
+    :param timings: Timings of the request
+    :return: iterator of the pages
+    """
+    for page in pages:
+        timings.rows_fetched += len(page)
+        timings.rows_rendered += len(page)
+        yield page
+
+
+def get_arrow_type(sql_type: str):
+    """Get the Arrow data type to use for a column with the given declared SQL type. This follows
+    the SQLite type affinity rules (matching whole words for integers), which also cover the common
+    Postgres types. Anything that is not recognized is stored as a string.
+
+    :param sql_type: declared SQL type (e.g., from get_sql_column_types)
+    :return: pyarrow DataType
+    """
+    import pyarrow as pa
+
+    sql_type = sql_type.lower()
+    if ARROW_INT_TYPE.search(sql_type):
+        return pa.int64()
+    if "char" in sql_type or "clob" in sql_type or "text" in sql_type:
+        return pa.string()
+    if "blob" in sql_type or "bytea" in sql_type:
+        return pa.binary()
+    for t in ["real", "floa", "doub", "numeric", "decimal"]:
+        if t in sql_type:
+            return pa.float64()
+    if "bool" in sql_type:
+        return pa.bool_()
+    if sql_type == "date":
+        return pa.date32()
+    if sql_type.startswith("timestamp"):
+        if "with time zone" in sql_type:
+            return pa.timestamp("us", tz="UTC")
+        return pa.timestamp("us")
+    return pa.string()
+
+
+def iter_swagger_pages(
+    client: HTTPClient,
+    swagger_url: str,
+    table: str,
+    request_args: dict,
+    offset: int,
+    limit: int,
+    page_size: int = SWAGGER_PAGE_SIZE,
+) -> Iterator[list]:
+    """Request rows from a Swagger endpoint one page at a time, so that large exports do not need
+    to be held in memory or sent in a single request (which the endpoint may truncate). The
+    endpoint may also return fewer rows than requested (e.g., PostgREST max-rows), so pages are
+    requested until there are no more rows or the limit is reached.
+
+    :param client: HTTPClient to send requests with
+    :param swagger_url: URL to remote database (Swagger)
+    :param table: table name
+    :param request_args: dict of HTTP request args (Flask request.args)
+    :param offset: number of rows to skip
+    :param limit: max number of rows to return
+    :param page_size: max number of rows to request at once
+    :return: iterator of pages, each a list of rows as dicts (the first page may instead be the
+             error dict from the endpoint)
+    """
+    page_args = request_args.copy()
+    first = True
+    while limit > 0:
+        page_args["offset"] = offset
+        page_args["limit"] = min(limit, page_size)
+        url = get_swagger_url(swagger_url, table, page_args)
+        data = client.get(url).json()
+        if type(data) == dict and not first:
+            # The response has already started, so we can only stop the export
+            logging.error(f"Export stopped by error from {url}: {data.get('message')}")
+            return
+        yield data
+        if not data or type(data) == dict:
+            return
+        first = False
+        offset += len(data)
+        limit -= len(data)
+
+
+def stream_arrow_table(
+    headers: List[str],
+    types: List[str],
+    rows: Iterable,
+    fmt: str = "arrow",
+    batch_size: int = 65536,
+) -> Iterator[bytes]:
+    """Render rows as an Arrow IPC stream or a Parquet file, built in record batches so that the
+    output can be sent as it is created without holding the full table in memory. This requires
+    the pyarrow module.
+
+    :param headers: column names
+    :param types: declared SQL type of each column, used to choose the Arrow data types
+    :param rows: iterable of rows, each as a sequence of values in the same order as headers
+                 (e.g., a streamed database result)
+    :param fmt: output format (arrow or parquet)
+    :param batch_size: number of rows in each record batch (and Parquet row group)
+    :return: iterator of bytes chunks of the output
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SprocketError(f"The pyarrow module must be installed to use '{fmt}' format")
+
+    schema = pa.schema([pa.field(h, get_arrow_type(t)) for h, t in zip(headers, types)])
+    converters = {
+        pa.int64(): int,
+        pa.float64(): float,
+        pa.bool_(): bool,
+        pa.string(): str,
+    }
+    warned = set()
+
+    def to_array(values, field):
+        try:
+            return pa.array(values, type=field.type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+        if pa.types.is_temporal(field.type):
+            # SQLite returns dates and timestamps as ISO strings, which Arrow can parse
+            try:
+                return pa.array(values, type=pa.string()).cast(field.type)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                pass
+        # SQLite does not enforce types, so convert values one at a time
+        convert = converters.get(field.type)
+        if not convert and pa.types.is_temporal(field.type):
+
+            def convert(v):
+                return pa.scalar(str(v)).cast(field.type).as_py()
+
+        converted = []
+        for v in values:
+            if v is not None:
+                try:
+                    if not convert:
+                        # No conversion for binary values
+                        raise TypeError()
+                    v = convert(v)
+                except (TypeError, ValueError):
+                    if field.name not in warned:
+                        warned.add(field.name)
+                        logging.warning(
+                            f"Some values of '{field.name}' could not be converted to "
+                            f"{field.type} and were replaced with nulls"
+                        )
+                    v = None
+            converted.append(v)
+        return pa.array(converted, type=field.type)
+
+    def generate():
+        nonlocal rows
+        if not hasattr(rows, "fetchmany"):
+            rows = iter(rows)
+        sink = BytesIO()
+        if fmt == "parquet":
+            writer = pq.ParquetWriter(sink, schema)
+        else:
+            writer = pa.ipc.new_stream(sink, schema)
+        try:
+            while True:
+                if hasattr(rows, "fetchmany"):
+                    batch = rows.fetchmany(batch_size)
+                else:
+                    batch = [row for _, row in zip(range(batch_size), rows)]
+                if not batch:
+                    break
+                columns = list(zip(*batch))
+                arrays = [to_array(list(columns[i]), f) for i, f in enumerate(schema)]
+                writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                yield sink.getvalue()
+                sink.seek(0)
+                sink.truncate()
+        finally:
+            if hasattr(rows, "close"):
+                # Release the database cursor, even if the client disconnects before the end
+                rows.close()
+        writer.close()
+        yield sink.getvalue()
+
+    # Return the generator from a regular function so that missing pyarrow is raised right away
+    return generate()
+
+
+def stream_json_table(
+    headers: List[str],
+    rows: Iterable,
+    fmt: str = "json",
+    expand_meta: bool = False,
+    chunk_size: int = 1000,
+) -> Iterator[str]:
+    """Render rows as a JSON array of objects, or as NDJSON (one object per line), in chunks so
+    that the output can be sent as it is created without holding the full table in memory.
+
+    :param headers: column names to use as the keys of each object
+    :param rows: iterable of rows, each as a sequence of values in the same order as headers
+                 (e.g., a streamed database result)
+    :param fmt: output format (json or ndjson)
+    :param expand_meta: if True, decode the JSON of *_meta columns into objects
+    :param chunk_size: number of rows to include in each chunk
+    :return: iterator of string chunks of the output
+    """
+    meta_idx = []
+    if expand_meta:
+        meta_idx = [i for i, h in enumerate(headers) if h.endswith("_meta")]
+    if fmt == "ndjson":
+        start, sep, end = "", "\n", "\n"
+    else:
+        start, sep, end = "[", ",\n", "]\n"
+    chunk = [start]
+    try:
+        for n, row in enumerate(rows):
+            values = list(row)
+            for i in meta_idx:
+                if isinstance(values[i], str):
+                    try:
+                        values[i] = json.loads(values[i])
+                    except ValueError:
+                        # Not valid JSON, keep the original string
+                        pass
+            if n > 0:
+                chunk.append(sep)
+            chunk.append(json.dumps(dict(zip(headers, values)), default=str))
+            if (n + 1) % chunk_size == 0:
+                yield "".join(chunk)
+                chunk = []
+    finally:
+        if hasattr(rows, "close"):
+            # Release the database cursor, even if the client disconnects before the end
+            rows.close()
+    if fmt == "ndjson" and chunk == [start]:
+        # No results
+        end = ""
+    chunk.append(end)
+    yield "".join(chunk)
+
+
+def stream_tsv_table(
+    headers: Iterable[str], rows: Iterable, fmt: str = "tsv", chunk_size: int = 1000
+) -> Iterator[str]:
+    """Render rows as TSV (or CSV) in chunks, so that the output can be sent as it is created
+    without holding the full table in memory.
+
+    :param headers: column names for the first line
+    :param rows: iterable of rows, each as a sequence of values in the same order as headers
+                 (e.g., a streamed database result)
+    :param fmt: table format (tsv or csv)
+    :param chunk_size: number of rows to include in each chunk
+    :return: iterator of string chunks of the table output
+    """
     output = StringIO()
     sep = "\t"
     if fmt == "csv":
         sep = ","
-    writer = csv.DictWriter(output, delimiter=sep, fieldnames=list(headers), lineterminator="\n")
-    writer.writeheader()
-    writer.writerows(list(data))
-    return output.getvalue()
+    writer = csv.writer(output, delimiter=sep, lineterminator="\n")
+    writer.writerow(list(headers))
+    try:
+        for n, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if n % chunk_size == 0:
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate()
+    finally:
+        if hasattr(rows, "close"):
+            # Release the database cursor, even if the client disconnects before the end
+            rows.close()
+    yield output.getvalue()
@@ -1,15 +1,30 @@
+import json
+import logging
 import os
 
 from argparse import ArgumentParser
 from configparser import ConfigParser
-from flask import abort, Flask, Blueprint, render_template, request
+from flask import abort, Flask, Blueprint, g, request, Response
 from sqlalchemy import create_engine
-from sqlalchemy.engine import Connection
-from typing import Optional
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.pool import QueuePool
+from typing import Iterable, Iterator, Optional
 from urllib.parse import urlparse
 from wsgiref.handlers import CGIHandler
-from .render import render_database_table, render_swagger_table
-from .lib import get_sql_tables, get_swagger_tables, SprocketError
+from .render import render_database_table, render_summary, render_swagger_table, template_env
+from .lib import (
+    build_violation_index,
+    get_sql_columns,
+    get_sql_tables,
+    get_swagger_tables,
+    HTTPClient,
+    Metrics,
+    ResponseCache,
+    SchemaCache,
+    SlowQueryLog,
+    SprocketError,
+    Timings,
+)
 
 BLUEPRINT = Blueprint(
     "sprocket",
@@ -17,63 +32,320 @@ BLUEPRINT = Blueprint(
     template_folder=os.path.abspath(os.path.join(os.path.dirname(__file__), "templates")),
 )
 
-CONN = None  # type: Optional[Connection]
+COUNT_CACHE = None  # type: Optional[ResponseCache]
 DB = None  # type: Optional[str]
 DEFAULT_LIMIT = 100
 DEFAULT_TABLE = None  # type: Optional[str]
+ENGINE = None  # type: Optional[Engine]
+HTTP_CLIENT = None  # type: Optional[HTTPClient]
+JSON_META = False
+KEYSET = False
+LOG_TIMINGS = False
+METRICS = None  # type: Optional[Metrics]
+RESPONSE_CACHE = None  # type: Optional[ResponseCache]
+SCHEMA_CACHE = None  # type: Optional[SchemaCache]
+SLOW_QUERY_LOG = None  # type: Optional[SlowQueryLog]
+STREAM_HTML = False
+SUMMARY_CACHE = None  # type: Optional[ResponseCache]
+VIOLATION_TABLES = set()  # type: set
+
+# Options for the ENGINE connection pool, as [pool] keys in the .ini file -> create_engine args
+POOL_OPTIONS = {
+    "size": ("pool_size", int),
+    "max_overflow": ("max_overflow", int),
+    "recycle": ("pool_recycle", int),
+    "pre_ping": ("pool_pre_ping", lambda x: x.lower() in ["true", "yes", "on", "1"]),
+}
+
+# Max seconds to reuse a cached table summary or count, unless --response-cache-ttl is set. These
+# are also refreshed when the data changes, but not every database has a data version.
+SUMMARY_TTL = 300
 
 # TODO: select is not maintained when using a filter
 
 
+@BLUEPRINT.before_request
+def start_timings():
+    """Start the timings for this request, if metrics or timing logs are enabled."""
+    if METRICS or LOG_TIMINGS:
+        g.sprocket_timings = Timings()
+
+
+@BLUEPRINT.after_request
+def add_timings(response):
+    """Add the timings of the phases of this request so far as a Server-Timing header (when
+    metrics are enabled), and record the metrics (and log line) for the request once the response
+    has been sent. Phases of a streamed response that happen while it is sent are only included in
+    the metrics and log."""
+    timings = g.pop("sprocket_timings", None)
+    if timings is None:
+        return response
+    if METRICS:
+        response.headers["Server-Timing"] = timings.get_server_timing()
+    if response.is_streamed:
+        response.response = count_bytes(response.response, timings)
+    else:
+        timings.bytes_out = response.content_length or 0
+    endpoint = request.endpoint
+    method = request.method
+    path = request.full_path if request.query_string else request.path
+    status = response.status_code
+
+    def finish():
+        timings.finish()
+        if METRICS:
+            METRICS.observe(timings, endpoint, status)
+        if LOG_TIMINGS:
+            details = {"method": method, "path": path, "status": status}
+            details.update(timings.to_dict())
+            logging.info(json.dumps(details))
+
+    response.call_on_close(finish)
+    return response
+
+
+@BLUEPRINT.after_request
+def release_connection(response):
+    """Return the connection for this request (if any) to the ENGINE pool once the response has
+    been sent. Exports are streamed from the database, so we can't close it at teardown."""
+    conn = g.pop("sprocket_conn", None)
+    if conn is not None:
+        response.call_on_close(conn.close)
+    return response
+
+
+@BLUEPRINT.teardown_request
+def close_connection(exc):
+    """Return the connection for this request to the ENGINE pool if the request failed before a
+    response was created."""
+    conn = g.pop("sprocket_conn", None)
+    if conn is not None:
+        conn.close()
+
+
+def count_bytes(chunks: Iterable, timings: Timings) -> Iterator[bytes]:
+    """Count the bytes of a streamed response in the timings of the request as they are sent.
+
+    :param chunks: iterable of the chunks (strings or bytes) of the response
+    :param timings: Timings of the request
+    :return: iterator of the encoded chunks
+    """
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            timings.bytes_out += len(chunk)
+            yield chunk
+    finally:
+        # The original iterable must be closed, e.g., to close the database results
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def get_connection() -> Connection:
+    """Get the database connection for the current request. The connection is checked out from
+    the ENGINE pool the first time this is called during a request, and returned to the pool when
+    the response is closed.
+
+    :return: database connection
+    """
+    if "sprocket_conn" not in g:
+        g.sprocket_conn = ENGINE.connect()
+    return g.sprocket_conn
+
+
 @BLUEPRINT.route("/", methods=["GET"])
 def show_tables():
     if DEFAULT_TABLE:
         try:
-            return render_database_table(CONN, DEFAULT_TABLE, request.args)
+            return render_database_table(
+                get_connection(),
+                DEFAULT_TABLE,
+                request.args,
+                count_cache=COUNT_CACHE,
+                json_meta=JSON_META,
+                keyset=KEYSET,
+                response_cache=RESPONSE_CACHE,
+                schema_cache=SCHEMA_CACHE,
+                slow_query_log=SLOW_QUERY_LOG,
+                stream_html=STREAM_HTML,
+                summary_url=f"./{DEFAULT_TABLE}/summary",
+                timings=g.get("sprocket_timings"),
+                violation_index=DEFAULT_TABLE in VIOLATION_TABLES,
+            )
         except SprocketError as e:
             abort(422, str(e))
-    if CONN:
-        tables = get_sql_tables(CONN)
+    if ENGINE and SCHEMA_CACHE:
+        tables = SCHEMA_CACHE.get_tables(get_connection())
+    elif ENGINE:
+        tables = get_sql_tables(get_connection())
     else:
-        tables = get_swagger_tables(DB)
-    return render_template("index.html", title="sprocket", tables=tables)
+        tables = get_swagger_tables(DB, client=HTTP_CLIENT)
+    return template_env.get_template("index.html").render(title="sprocket", tables=tables)
 
 
 @BLUEPRINT.route("/<table>", methods=["GET"])
 def get_table_by_name(table):
     if table == "favicon.ico":
-        return render_template("test.html")
+        abort(404)
     try:
-        if CONN:
-            return render_database_table(CONN, table, request.args, default_limit=DEFAULT_LIMIT)
+        if ENGINE:
+            return render_database_table(
+                get_connection(),
+                table,
+                request.args,
+                count_cache=COUNT_CACHE,
+                default_limit=DEFAULT_LIMIT,
+                json_meta=JSON_META,
+                keyset=KEYSET,
+                response_cache=RESPONSE_CACHE,
+                schema_cache=SCHEMA_CACHE,
+                slow_query_log=SLOW_QUERY_LOG,
+                stream_html=STREAM_HTML,
+                summary_url=f"./{table}/summary",
+                timings=g.get("sprocket_timings"),
+                violation_index=table in VIOLATION_TABLES,
+            )
         else:
-            return render_swagger_table(DB, table, request.args, default_limit=DEFAULT_LIMIT)
+            return render_swagger_table(
+                DB,
+                table,
+                request.args,
+                client=HTTP_CLIENT,
+                default_limit=DEFAULT_LIMIT,
+                stream_html=STREAM_HTML,
+                timings=g.get("sprocket_timings"),
+            )
+    except SprocketError as e:
+        abort(422, str(e))
+
+
+@BLUEPRINT.route("/-/metrics", methods=["GET"])
+def get_metrics():
+    if not METRICS:
+        abort(404)
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+
+@BLUEPRINT.route("/<table>/summary", methods=["GET"])
+def get_table_summary(table):
+    if not ENGINE:
+        abort(404)
+    try:
+        return render_summary(
+            get_connection(),
+            table,
+            json_meta=JSON_META,
+            response_cache=RESPONSE_CACHE or SUMMARY_CACHE,
+            schema_cache=SCHEMA_CACHE,
+            timings=g.get("sprocket_timings"),
+            violation_index=table in VIOLATION_TABLES,
+        )
     except SprocketError as e:
         abort(422, str(e))
 
 
-def prepare(db, table=None, limit=None):
+def prepare(
+    db,
+    table=None,
+    limit=None,
+    keyset=False,
+    schema_ttl=60,
+    pool_options=None,
+    http_options=None,
+    stream_html=False,
+    cache_options=None,
+    violation_index=False,
+    json_meta=False,
+    metrics=False,
+    log_timings=False,
+    slow_query=None,
+    explain_analyze=False,
+):
     """Prepare the global vars for running sprocket:
-    - CONN: database connection created from DB (None when DB is a Swagger endpoint)
+    - COUNT_CACHE: cache for the total number of results of each table and set of filters
     - DB: SQLite database file, Postgres config file, or Swagger endpoint URL
     - DEFAULT_LIMIT: max number of results to display on a page when limit is not in query params
     - DEFAULT_TABLE: table to redirect to from index page
+    - ENGINE: database engine created from DB (None when DB is a Swagger endpoint). Each request
+      gets its own connection from the engine's connection pool.
+    - HTTP_CLIENT: client for requests to DB (None when DB is not a Swagger endpoint)
+    - JSON_META: if True, use the JSON functions of the database on *_meta columns
+    - KEYSET: if True, use keyset pagination for database tables
+    - LOG_TIMINGS: if True, log the timings of each request as a JSON line
+    - METRICS: totals of the timings of all requests (None when disabled)
+    - RESPONSE_CACHE: cache for rendered pages & exports (None when disabled)
+    - SCHEMA_CACHE: cache for tables & columns (None when disabled)
+    - SLOW_QUERY_LOG: log for slow queries (None when disabled)
+    - STREAM_HTML: if True, stream HTML pages as they are rendered
+    - SUMMARY_CACHE: cache for table summaries when RESPONSE_CACHE is disabled
+    - VIOLATION_TABLES: tables with a violation index, which is used to filter violations
 
     :param db: SQLite database file, Postgres config file, or Swagger endpoint URL
     :param table: table to set as DEFAULT_TABLE
     :param limit: int to set as DEFAULT_LIMIT
+    :param keyset: bool to set as KEYSET
+    :param schema_ttl: seconds to keep tables & columns in SCHEMA_CACHE (0 to disable the cache)
+    :param pool_options: dict of create_engine pool args (pool_size, max_overflow, pool_recycle,
+                         pool_pre_ping) for ENGINE. For Postgres, these override the options in
+                         the [pool] section of the config file.
+    :param http_options: dict of HTTPClient args (pool_size, timeout, cache_size, cache_dir,
+                         cache_pages, disk_cache_size, prefetch_workers) for HTTP_CLIENT
+    :param stream_html: bool to set as STREAM_HTML
+    :param cache_options: dict of ResponseCache args (max_size, ttl, version_query) for
+                          RESPONSE_CACHE, or None to disable the cache
+    :param violation_index: if True, build the violation index for each database table with a
+                            row_number column and *_meta columns, and add it to VIOLATION_TABLES
+    :param json_meta: bool to set as JSON_META
+    :param metrics: if True, record the timings of each request in METRICS and add them to the
+                    response as a Server-Timing header
+    :param log_timings: bool to set as LOG_TIMINGS
+    :param slow_query: min seconds for a query to be logged in SLOW_QUERY_LOG, or None to disable
+                       the log
+    :param explain_analyze: if True, include the actual times of each step in the query plans of
+                            slow queries (Postgres only, the query is run again)
     """
-    global CONN, DB, DEFAULT_LIMIT, DEFAULT_TABLE
+    global COUNT_CACHE, DB, DEFAULT_LIMIT, DEFAULT_TABLE, ENGINE, HTTP_CLIENT, JSON_META, KEYSET
+    global LOG_TIMINGS, METRICS, RESPONSE_CACHE, SCHEMA_CACHE, SLOW_QUERY_LOG, STREAM_HTML
+    global SUMMARY_CACHE, VIOLATION_TABLES
+    HTTP_CLIENT = None
+    JSON_META = json_meta
+    LOG_TIMINGS = log_timings
+    METRICS = Metrics() if metrics else None
+    SLOW_QUERY_LOG = None
+    if slow_query is not None:
+        SLOW_QUERY_LOG = SlowQueryLog(threshold=slow_query, analyze=explain_analyze)
+    VIOLATION_TABLES = set()
+    KEYSET = keyset
+    RESPONSE_CACHE = None
+    if cache_options is not None:
+        cache_options = {k: v for k, v in cache_options.items() if v is not None}
+        RESPONSE_CACHE = ResponseCache(**cache_options)
+    # Summaries are always cached, since they are computed from the whole table
+    SUMMARY_CACHE = ResponseCache(
+        max_size=4 * 1024 * 1024,
+        ttl=(cache_options or {}).get("ttl", SUMMARY_TTL),
+        version_query=(cache_options or {}).get("version_query"),
+    )
+    # Counts are cached so that turning pages does not count all the results again
+    COUNT_CACHE = ResponseCache(
+        max_size=1024 * 1024,
+        ttl=(cache_options or {}).get("ttl", SUMMARY_TTL),
+        version_query=(cache_options or {}).get("version_query"),
+    )
+    STREAM_HTML = stream_html
+    SCHEMA_CACHE = SchemaCache(ttl=schema_ttl) if schema_ttl else None
     if limit:
         DEFAULT_LIMIT = limit
     if table:
         DEFAULT_TABLE = table
     DB = db
+    pool_options = {k: v for k, v in (pool_options or {}).items() if v is not None}
     if DB.endswith(".db"):
         abspath = os.path.abspath(DB)
+        # Pooled connections are shared between threads, but only used by one request at a time
         db_url = "sqlite:///" + abspath + "?check_same_thread=False"
-        engine = create_engine(db_url)
-        CONN = engine.connect()
+        ENGINE = create_engine(db_url, poolclass=QueuePool, **pool_options)
     elif DB.endswith(".ini"):
         config_parser = ConfigParser()
         config_parser.read(DB)
@@ -103,14 +375,85 @@ def prepare(db, table=None, limit=None):
         pg_host = params.get("host", "127.0.0.1")
         pg_port = params.get("port", "5432")
         db_url = f"postgresql+psycopg2://{pg_user}:{pg_pw}@{pg_host}:{pg_port}/{pg_db}"
-        engine = create_engine(db_url)
-        CONN = engine.connect()
+        options = {}
+        if config_parser.has_section("pool"):
+            for key, value in config_parser.items("pool"):
+                if key not in POOL_OPTIONS:
+                    raise SprocketError(f"Unknown option '{key}' in [pool] section of " + DB)
+                arg, convert = POOL_OPTIONS[key]
+                try:
+                    options[arg] = convert(value)
+                except ValueError:
+                    raise SprocketError(f"Invalid value for '{key}' in [pool] section of " + DB)
+        options.update(pool_options)
+        ENGINE = create_engine(db_url, **options)
     else:
         # Assume this is a Swagger endpoint, check that it is a well-formed URL
         # (if it isn't an endpoint, sprocket will fail when we try to query)
+        ENGINE = None
+        http_options = {k: v for k, v in (http_options or {}).items() if v is not None}
+        HTTP_CLIENT = HTTPClient(**http_options)
         res = urlparse(DB)
         if not all([res.scheme, res.netloc]):
             raise SprocketError("Unable to parse endpoint URL: " + DB)
+        return
+
+    if violation_index:
+        with ENGINE.connect() as conn:
+            for t in get_sql_tables(conn):
+                columns = get_sql_columns(conn, t)
+                if "row_number" in columns and any(x.endswith("_meta") for x in columns):
+                    build_violation_index(conn, t)
+                    VIOLATION_TABLES.add(t)
+
+
+def create_app(db, **kwargs) -> Flask:
+    """Prepare the global vars (see prepare) and create a Flask app that serves sprocket at the
+    base path. This can be used as the app for a WSGI server, e.g.:
+    gunicorn "sprocket.run:create_app('database.db')"
+
+    :param db: SQLite database file, Postgres config file, or Swagger endpoint URL
+    :param kwargs: other args for prepare
+    :return: Flask app
+    """
+    prepare(db, **kwargs)
+    app = Flask(__name__)
+    app.register_blueprint(BLUEPRINT)
+    app.url_map.strict_slashes = False
+    return app
+
+
+def serve(app: Flask, host=None, port=None, workers=1, threads=1):
+    """Serve the app with gunicorn, using multiple worker processes and threads to handle requests
+    concurrently. Each worker has its own ENGINE connection pool.
+
+    :param app: Flask app to serve
+    :param host: host to listen on (default: 127.0.0.1)
+    :param port: port to listen on (default: 5000)
+    :param workers: number of worker processes
+    :param threads: number of threads to handle requests with in each worker
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SprocketError("The 'gunicorn' module must be installed to use workers or threads")
+
+    def post_fork(server, worker):
+        # Connections cannot be shared between processes, so each worker opens its own
+        if ENGINE:
+            ENGINE.dispose()
+
+    class SprocketApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host or '127.0.0.1'}:{port or 5000}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("post_fork", post_fork)
+
+        def load(self):
+            return app
+
+    SprocketApplication().run()
 
 
 def main():
@@ -120,19 +463,163 @@ def main():
     parser.add_argument("-l", "--limit", help="Default limit for results (default: 100)", type=int)
     parser.add_argument("-c", "--cgi", help="Run as CGI script", action="store_true")
     parser.add_argument("-s", "--save-cache", help="Save Swagger cache", action="store_true")
+    parser.add_argument("--host", help="Host to listen on (default: 127.0.0.1)")
+    parser.add_argument("-p", "--port", help="Port to listen on (default: 5000)", type=int)
+    parser.add_argument(
+        "-w", "--workers", help="Number of worker processes (requires gunicorn)", type=int
+    )
+    parser.add_argument(
+        "--threads", help="Number of threads for each worker (requires gunicorn)", type=int
+    )
+    parser.add_argument(
+        "-k", "--keyset", help="Use keyset pagination for database tables", action="store_true"
+    )
+    parser.add_argument(
+        "--stream-html",
+        help="Send HTML pages while they are rendered (for large pages)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--response-cache",
+        help="Cache up to this many MB of rendered pages and exports (default: disabled)",
+        type=float,
+    )
+    parser.add_argument(
+        "--response-cache-ttl", help="Max seconds to reuse a cached response", type=float
+    )
+    parser.add_argument(
+        "--version-query",
+        help="SQL query for a value that changes when the data changes (for the response cache)",
+    )
+    parser.add_argument(
+        "--violation-index",
+        help="Index the violations in *_meta columns at startup to filter them faster",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--json-meta",
+        help="Use the JSON functions of the database to filter and read *_meta columns",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Add Server-Timing headers and serve request metrics at /-/metrics",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--log-timings", help="Log the timings of each request as JSON", action="store_true"
+    )
+    parser.add_argument(
+        "--slow-query",
+        help="Log queries that take longer than this many seconds, with their query plans",
+        type=float,
+    )
+    parser.add_argument(
+        "--explain-analyze",
+        help="Include actual times in the plans of slow queries (Postgres, runs queries again)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--schema-ttl",
+        help="Seconds to cache tables and columns (default: 60, 0 to disable)",
+        type=float,
+        default=60,
+    )
+    parser.add_argument("--pool-size", help="Number of pooled database connections", type=int)
+    parser.add_argument(
+        "--max-overflow", help="Number of connections allowed beyond the pool size", type=int
+    )
+    parser.add_argument(
+        "--pool-recycle", help="Seconds after which pooled connections are replaced", type=int
+    )
+    parser.add_argument(
+        "--pool-pre-ping",
+        help="Test pooled connections before each request",
+        action="store_true",
+        default=None,
+    )
+    parser.add_argument(
+        "--http-pool-size", help="Number of connections to a Swagger endpoint to keep", type=int
+    )
+    parser.add_argument(
+        "--http-timeout", help="Seconds to wait for a Swagger endpoint (default: 30)", type=float
+    )
+    parser.add_argument(
+        "--http-cache-size", help="Number of Swagger responses to cache (default: 128)", type=int
+    )
+    parser.add_argument(
+        "--http-prefetch",
+        help="Number of threads to prefetch next pages from a Swagger endpoint with "
+        "(default: 2, 0 to disable)",
+        type=int,
+    )
+    parser.add_argument(
+        "--save-pages", help="Also save table pages in the Swagger cache", action="store_true"
+    )
+    parser.add_argument(
+        "--save-cache-size",
+        help="Max size in MB of the saved Swagger cache (default: 64)",
+        type=float,
+        default=64,
+    )
     args = parser.parse_args()
+    if args.cgi and args.violation_index:
+        # Each CGI request would rebuild the whole index, while other requests are reading it
+        parser.error("--violation-index cannot be used with --cgi")
+    if args.log_timings:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
 
-    # Set up some globals and the database connection
-    prepare(args.db, table=args.table, limit=args.limit)
+    # Set up some globals and the database connection, and register blueprint
+    app = create_app(
+        args.db,
+        table=args.table,
+        limit=args.limit,
+        keyset=args.keyset,
+        schema_ttl=args.schema_ttl,
+        stream_html=args.stream_html,
+        violation_index=args.violation_index,
+        json_meta=args.json_meta,
+        metrics=args.metrics,
+        log_timings=args.log_timings,
+        slow_query=args.slow_query,
+        explain_analyze=args.explain_analyze,
+        cache_options={
+            "max_size": int(args.response_cache * 1024 * 1024),
+            "ttl": args.response_cache_ttl,
+            "version_query": args.version_query,
+        }
+        if args.response_cache
+        else None,
+        pool_options={
+            "pool_size": args.pool_size,
+            "max_overflow": args.max_overflow,
+            "pool_recycle": args.pool_recycle,
+            "pool_pre_ping": args.pool_pre_ping,
+        },
+        http_options={
+            "pool_size": args.http_pool_size,
+            "timeout": args.http_timeout,
+            "cache_size": args.http_cache_size,
+            # A CGI process exits after one request, so it would never use a prefetched page
+            "prefetch_workers": 0 if args.cgi else args.http_prefetch,
+            "cache_dir": ".swagger" if args.save_cache else None,
+            "cache_pages": args.save_pages,
+            "disk_cache_size": int(args.save_cache_size * 1024 * 1024),
+        },
+    )
 
-    # Register blueprint and run app
-    app = Flask(__name__)
-    app.register_blueprint(BLUEPRINT)
-    app.url_map.strict_slashes = False
     if args.cgi:
         CGIHandler().run(app)
+    elif args.workers or args.threads:
+        serve(
+            app,
+            host=args.host,
+            port=args.port,
+            workers=args.workers or 1,
+            threads=args.threads or 1,
+        )
     else:
-        app.run()
+        app.run(host=args.host, port=args.port)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,32 @@
+import os
+import sqlite3
+
+import pytest
+
+from sqlalchemy import create_engine
+
+RESOURCES = os.path.join(os.path.dirname(__file__), "resources")
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """SQLite database with the test table from resources/test.sql, plus a row_number column and
+    a test_view view. The *_meta values in test.sql are wrapped in json(...), so they are replaced
+    with the (compact) JSON that VALVE writes."""
+    path = str(tmp_path / "test.db")
+    with open(os.path.join(RESOURCES, "test.sql")) as f:
+        sql = f.read()
+    db = sqlite3.connect(path)
+    db.executescript(sql)
+    db.executescript(
+        """UPDATE test SET weight_meta = json(substr(weight_meta, 6, length(weight_meta) - 6))
+        WHERE weight_meta LIKE 'json(%)';
+        ALTER TABLE test ADD COLUMN row_number INTEGER;
+        UPDATE test SET row_number = rowid;
+        CREATE VIEW test_view AS SELECT * FROM test;"""
+    )
+    db.commit()
+    db.close()
+    engine = create_engine("sqlite:///" + path)
+    yield engine
+    engine.dispose()
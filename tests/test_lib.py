@@ -0,0 +1,288 @@
+import json
+import requests
+import time
+
+import pytest
+
+from sqlalchemy import create_engine
+from sprocket.lib import (
+    build_violation_index,
+    compile_transform,
+    count_query,
+    decode_meta,
+    exec_query,
+    get_order_by,
+    get_seek_clause,
+    get_sql_columns,
+    get_violation_counts,
+    get_violation_filter,
+    HTTPClient,
+    parse_condition,
+    parse_order_by,
+    ResponseCache,
+    SprocketError,
+    Timings,
+)
+from sprocket.render import render_database_table
+
+
+@pytest.mark.parametrize(
+    "column,expression,value",
+    [
+        ("id", "{id}", "123"),
+        ("id", "{id} + 1", "123"),
+        ("weight", "round({weight}, 1)", 12.345),
+        ("id", "'{id}'", "123"),
+        ("id", '"{id}".zfill(5)', "123"),
+        ("subject", "'{subject}'.upper()", "subject:1"),
+        ("id", "'http://example.com/{id}'", "123"),
+        ("id", "'<a href=\"/x/{id}\">{id}</a>'", "abc"),
+        ("id", "'{id}' + '-' + '{id}'", "abc"),
+        ("id", "'a' '{id}' 'c'", "b"),
+        ("id", '"""a {id} c"""', "b"),
+        ("id", "'{{}}{id}'", "b"),
+        ("id", "f'{{len(\"ab\")}}-{id}'", "c"),
+        ("id", "b'{id}'", "abc"),
+    ],
+)
+def test_compile_transform(column, expression, value):
+    # The expression was formatted and evaluated for each value before it was compiled
+    expected = eval(expression.format(**{column: value}))
+    assert compile_transform(column, expression)(value) == expected
+
+
+@pytest.mark.parametrize(
+    "expression", ["'{id}", "{other}", "{id}.__class__", "'{id}'.__class__", "open('{id}')"]
+)
+def test_compile_transform_invalid(expression):
+    with pytest.raises(SprocketError):
+        compile_transform("id", expression)("1")
+
+
+def test_decode_meta(engine):
+    with engine.connect() as conn:
+        metas = [x[0] for x in conn.execute("SELECT weight_meta FROM test ORDER BY row_number")]
+    assert metas[0] is None
+    assert decode_meta(metas[1]) == {
+        "value": "NA",
+        "style": "null",
+        "message": None,
+        "conflict": False,
+    }
+    assert decode_meta(metas[2]) == {
+        "value": "11g",
+        "style": "error",
+        "message": "Must be a number",
+        "conflict": False,
+    }
+    assert decode_meta('{"value":"1","valid":true,"messages":[]}') is None
+    messages = [
+        {"rule": "key:primary", "level": "error", "message": 'Duplicate "1"'},
+        {"rule": "x", "level": "warn", "message": "Other"},
+    ]
+    assert decode_meta(json.dumps({"value": "1", "valid": False, "messages": messages})) == {
+        "value": "1",
+        "style": "error",
+        "message": "(1) Duplicate &quot;1&quot;<br>(2) Other",
+        "conflict": True,
+    }
+    # Messages do not need a rule
+    messages = [{"level": "warn", "message": "No rule"}]
+    assert decode_meta(json.dumps({"value": "1", "valid": False, "messages": messages})) == {
+        "value": "1",
+        "style": "warn",
+        "message": "No rule",
+        "conflict": False,
+    }
+
+
+@pytest.mark.parametrize(
+    "where,expected",
+    [
+        ("eq.foo", ("eq", "foo")),
+        ("gt.12", ("gt", 12)),
+        ("lte.1.5", ("lte", 1.5)),
+        ('eq."12"', ("eq", "12")),
+        ('eq."a \\"b\\", (c)"', ("eq", 'a "b", (c)')),
+        ("not.in.(a,2,\"b,c\")", ("not", "in", ("a", 2, "b,c"))),
+        ("is.null", ("is", "null")),
+        ("like.*foo*", ("like", "*foo*")),
+        ("foo.bar", None),
+        ("eq.(a", None),
+    ],
+)
+def test_parse_condition(where, expected):
+    # The LALR and Earley parsers give the same results
+    assert parse_condition(where, lalr=True) == expected
+    assert parse_condition(where, lalr=False) == expected
+
+
+@pytest.mark.parametrize(
+    "order", ["weight,row_number", "weight.desc.nullsfirst,row_number", "subject.desc,row_number"]
+)
+def test_get_seek_clause(engine, order):
+    order_by = parse_order_by(order)
+    keys = [x["key"] for x in order_by]
+    with engine.connect() as conn:
+        rows = exec_query(conn, "test", select=keys, order_by=get_order_by(order_by))
+        rows = [[x[k] for k in keys] for x in rows]
+        for i, cursor in enumerate(rows):
+            # Rows after the cursor, as with OFFSET
+            seek = get_seek_clause(order_by, cursor)
+            after = exec_query(
+                conn, "test", select=keys, order_by=get_order_by(order_by), seek=seek
+            )
+            assert [[x[k] for k in keys] for x in after] == rows[i + 1 :]
+            # Rows before the cursor, which are retrieved in reverse
+            seek = get_seek_clause(order_by, cursor, reverse=True)
+            before = exec_query(
+                conn, "test", select=keys, order_by=get_order_by(order_by, reverse=True), seek=seek
+            )
+            assert [[x[k] for k in keys] for x in before] == rows[:i][::-1]
+
+
+def test_timings(monkeypatch):
+    clock = iter([0.0, 1.0, 1.5, 2.0, 4.0, 5.0, 5.5, 6.0, 6.5, 10.0])
+    monkeypatch.setattr("sprocket.lib.time.perf_counter", lambda: next(clock))
+    timings = Timings()  # 0.0
+    timings.start("query")  # 1.0
+    timings.start("format")  # 1.5
+    timings.stop()  # 2.0
+    timings.stop()  # 4.0
+    # Each item is timed, without the time between items
+    assert list(timings.time_iter("render", ["a"])) == ["a"]  # 5.0, 5.5 and 6.0, 6.5
+    timings.rows_fetched = 2
+    timings.finish()  # 10.0
+    # The time of nested phases is not included in their parents
+    assert timings.phases == {"query": 2.5, "format": 0.5, "render": 1.0}
+    assert timings.to_dict() == {
+        "total_ms": 10000.0,
+        "phases_ms": {"query": 2500.0, "format": 500.0, "render": 1000.0},
+        "rows_fetched": 2,
+        "rows_rendered": 0,
+        "bytes_out": 0,
+    }
+
+
+@pytest.mark.parametrize("json_dialect", [None, "sqlite"])
+def test_get_violation_filter(engine, json_dialect):
+    with engine.connect() as conn:
+        for levels, expected in [(["error"], ["subject:3"]), (["warn", "info"], [])]:
+            where = get_violation_filter("weight_meta", levels, json_dialect=json_dialect)
+            rows = conn.execute(f"SELECT subject FROM test WHERE {where}").fetchall()
+            assert [x["subject"] for x in rows] == expected
+
+
+def test_get_violation_filter_invalid_level():
+    with pytest.raises(SprocketError):
+        get_violation_filter("weight_meta", ["bad"])
+
+
+def test_build_violation_index(engine):
+    with engine.connect() as conn:
+        assert build_violation_index(conn, "test") == 1
+        # Rebuilding replaces the old rows
+        assert build_violation_index(conn, "test") == 1
+        rows = conn.execute('SELECT * FROM "sprocket_violations"').fetchall()
+        assert [tuple(x) for x in rows] == [("test", 3, "weight", "error")]
+
+
+@pytest.mark.parametrize("table", ["test", "test_view"])
+def test_violation_index_filter(engine, table):
+    with engine.connect() as conn:
+        build_violation_index(conn, "test")
+        columns = get_sql_columns(conn, table)
+        kwargs = {"columns": columns, "violations": ["error"], "index_table": "test"}
+        rows = exec_query(conn, table, select=["subject"], **kwargs)
+        assert [x["subject"] for x in rows] == ["subject:3"]
+        assert count_query(conn, table, **kwargs) == 1
+
+
+def test_violation_index_conflict(engine):
+    error = '{"value":"x","valid":false,"messages":[{"level":"error","message":"Duplicate"}]}'
+    with engine.connect() as conn:
+        conn.execute("CREATE TABLE test_conflict AS SELECT * FROM test WHERE 0")
+        conn.execute(
+            "INSERT INTO test_conflict (subject, weight_meta, row_number) "
+            f"VALUES ('subject:4', '{error}', 4), ('subject:5', NULL, 5)"
+        )
+        conn.execute("DROP VIEW test_view")
+        conn.execute(
+            "CREATE VIEW test_view AS SELECT * FROM test UNION ALL SELECT * FROM test_conflict"
+        )
+        assert build_violation_index(conn, "test") == 2
+        # The view has the rows of the conflict table, but the table and its summary do not
+        for table, expected in [("test", ["subject:3"]), ("test_view", ["subject:3", "subject:4"])]:
+            columns = get_sql_columns(conn, table)
+            kwargs = {"columns": columns, "violations": ["error"], "index_table": "test"}
+            rows = exec_query(conn, table, select=["subject"], order_by=["subject"], **kwargs)
+            assert [x["subject"] for x in rows] == expected
+            assert count_query(conn, table, **kwargs) == len(expected)
+        counts = get_violation_counts(conn, "test", ["weight", "weight_meta"], violation_index=True)
+        assert counts["weight"]["error"] == 1
+
+
+@pytest.mark.parametrize("use_view", [False, True])
+@pytest.mark.parametrize("violation_index", [False, True])
+def test_render_violations(engine, use_view, violation_index):
+    with engine.connect() as conn:
+        if violation_index:
+            build_violation_index(conn, "test")
+        response = render_database_table(
+            conn,
+            "test",
+            {"violations": "error", "format": "json", "select": "subject"},
+            use_view=use_view,
+            violation_index=violation_index,
+        )
+        rows = json.loads(response.get_data())
+        assert [x["subject"] for x in rows] == ["subject:3"]
+
+
+def test_http_client_load(tmp_path):
+    url = "http://localhost:1/swagger"
+    r = requests.Response()
+    r.url = url
+    r.status_code = 200
+    r.headers["Content-Type"] = "application/json"
+    r.encoding = "utf-8"
+    r._content = b'{"definitions": {}}'
+    key = (url, ())
+    HTTPClient(cache_dir=str(tmp_path)).save(key, (time.time() + 60, r))
+
+    # A new client (e.g., in a new process) loads the saved response instead of sending a request
+    client = HTTPClient(cache_dir=str(tmp_path))
+    loaded = client.get(url, schema=True)
+    assert loaded.status_code == 200
+    assert loaded.headers["content-type"] == "application/json"
+    assert loaded.json() == {"definitions": {}}
+
+
+def test_response_cache(engine):
+    cache = ResponseCache()
+    with engine.connect() as conn:
+        version = cache.get_version(conn)
+    assert version is not None
+    cache.set("key", version, "text/html", "body")
+    assert cache.get("key", version) == ("text/html", "body")
+    assert cache.get("key", "new version") is None
+
+
+def test_response_cache_unknown_version():
+    # Without a data version, responses are only cached when they expire
+    cache = ResponseCache()
+    with create_engine("sqlite://").connect() as conn:
+        assert cache.get_version(conn) is None
+    cache.set("key", None, "text/html", "body")
+    assert cache.get("key", None) is None
+    cache = ResponseCache(ttl=60)
+    cache.set("key", None, "text/html", "body")
+    assert cache.get("key", None) == ("text/html", "body")
+
+
+def test_response_cache_version_query_error(engine):
+    # A version query that fails does not fail the request, but responses are not cached
+    cache = ResponseCache(version_query="SELECT missing_function()")
+    with engine.connect() as conn:
+        assert cache.get_version(conn) is None
+        assert conn.execute("SELECT 1").scalar() == 1
@@ -0,0 +1,149 @@
+from datetime import date, datetime
+from urllib.parse import parse_qs, urlparse
+
+import pyarrow as pa
+import pytest
+import sprocket.render
+
+from sprocket.lib import ResponseCache, SprocketError
+from sprocket.render import get_arrow_type, render_database_table, render_swagger_table
+
+
+@pytest.mark.parametrize(
+    "sql_type,arrow_type",
+    [
+        ("INTEGER", pa.int64()),
+        ("int", pa.int64()),
+        ("int8", pa.int64()),
+        ("bigint", pa.int64()),
+        ("unsigned big int", pa.int64()),
+        ("smallint", pa.int64()),
+        ("serial", pa.int64()),
+        ("TEXT", pa.string()),
+        ("character varying", pa.string()),
+        ("REAL", pa.float64()),
+        ("double precision", pa.float64()),
+        ("numeric(10, 2)", pa.float64()),
+        ("boolean", pa.bool_()),
+        ("date", pa.date32()),
+        ("timestamp without time zone", pa.timestamp("us")),
+        ("timestamp with time zone", pa.timestamp("us", tz="UTC")),
+        ("bytea", pa.binary()),
+        # These contain 'int' but are not integers
+        ("interval", pa.string()),
+        ("point", pa.string()),
+        ("", pa.string()),
+    ],
+)
+def test_get_arrow_type(sql_type, arrow_type):
+    assert get_arrow_type(sql_type) == arrow_type
+
+
+@pytest.mark.parametrize(
+    "args,expected",
+    [
+        # One row, shown in the vertical view
+        ({"subject": "eq.subject:1", "offset": "5"}, ["subject:1"]),
+        ({"subject": "eq.subject:1", "offset": "5", "limit": "1"}, ["subject:1"]),
+        ({"offset": "200", "limit": "1"}, ["subject:1"]),
+        # The first page of the table
+        ({"offset": "200"}, ["subject:1", "subject:2", "subject:3"]),
+        ({"offset": "3"}, ["subject:1", "subject:2", "subject:3"]),
+    ],
+)
+def test_offset_past_end(engine, args, expected):
+    # e.g., a filter was added on a later page, which keeps the offset
+    with engine.connect() as conn:
+        html = render_database_table(conn, "test", args, standalone=False)
+    for subject in ["subject:1", "subject:2", "subject:3"]:
+        assert (subject in html) == (subject in expected)
+
+
+def test_count_cache(engine, monkeypatch):
+    counts = []
+    count_query = sprocket.render.count_query
+
+    def counted(*args, **kwargs):
+        counts.append(args[1])
+        return count_query(*args, **kwargs)
+
+    monkeypatch.setattr(sprocket.render, "count_query", counted)
+    cache = ResponseCache()
+    with engine.connect() as conn:
+        # Turning pages only counts the results once
+        for args in [{"limit": "1"}, {"limit": "1", "after": "WzFd"}, {"limit": "2"}]:
+            render_database_table(conn, "test", args, count_cache=cache, keyset=True)
+        assert len(counts) == 1
+        # Other filters are counted separately
+        render_database_table(conn, "test", {"weight": "gt.1"}, count_cache=cache, keyset=True)
+        assert len(counts) == 2
+
+
+def test_arrow_dates(engine):
+    with engine.connect() as conn:
+        conn.execute("CREATE TABLE dates (day DATE, time TIMESTAMP, note TEXT)")
+        conn.execute(
+            """INSERT INTO dates VALUES ('2024-01-02', '2024-01-02 03:04:05', 'ok'),
+            (NULL, '2024-01-02T03:04:05.5', 'ok'), ('bad', 'bad', 'not a date')"""
+        )
+        response = render_database_table(conn, "dates", {"format": "arrow"})
+        data = b"".join(response.response)
+    # SQLite returns the values as strings, which are parsed instead of replaced with nulls
+    rows = pa.ipc.open_stream(data).read_all().to_pylist()
+    assert rows == [
+        {"day": date(2024, 1, 2), "time": datetime(2024, 1, 2, 3, 4, 5), "note": "ok"},
+        {"day": None, "time": datetime(2024, 1, 2, 3, 4, 5, 500000), "note": "ok"},
+        {"day": None, "time": None, "note": "not a date"},
+    ]
+
+
+class SwaggerClient:
+    """Send requests to an endpoint like PostgREST, which returns at most two rows for each request
+    and (without an order) returns the rows in a different order each time."""
+
+    def __init__(self, properties):
+        self.properties = properties
+        self.rows = [{"id": i, "label": f"row {i}"} for i in range(5)]
+        self.urls = []
+
+    def get(self, url, headers=None, schema=False):
+        if schema:
+            return FakeResponse({"definitions": {"test": {"properties": self.properties}}})
+        self.urls.append(url)
+        args = {k: v[0] for k, v in parse_qs(urlparse(url).query).items()}
+        rows = self.rows[len(self.urls) :] + self.rows[: len(self.urls)]
+        if "order" in args:
+            rows = sorted(rows, key=lambda x: [x[k] for k in args["order"].split(",")])
+        offset = int(args.get("offset", 0))
+        return FakeResponse(rows[offset : offset + min(int(args["limit"]), 2)])
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+@pytest.mark.parametrize(
+    "properties,args,order",
+    [
+        ({"label": {}, "id": {"description": "Note:\nThis is a Primary Key.<pk/>"}}, {}, "id"),
+        ({"id": {}, "label": {}}, {}, "id,label"),
+        ({}, {"order": "label"}, "label"),
+    ],
+)
+def test_swagger_export_order(properties, args, order):
+    client = SwaggerClient(properties)
+    response = render_swagger_table("http://x", "test", dict(args, format="tsv"), client=client)
+    lines = "".join(response.response).splitlines()
+    # Every page uses the same order, so each row is exported once
+    assert lines == ["id\tlabel"] + [f"{i}\trow {i}" for i in range(5)]
+    assert len(client.urls) == 4
+    assert all(parse_qs(urlparse(url).query)["order"] == [order] for url in client.urls)
+
+
+def test_swagger_export_order_required():
+    with pytest.raises(SprocketError):
+        render_swagger_table("http://x", "test", {"format": "tsv"}, client=SwaggerClient({}))
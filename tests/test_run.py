@@ -0,0 +1,52 @@
+import pytest
+
+from flask import Flask
+from sprocket import run
+
+
+@pytest.fixture
+def client(engine):
+    run.prepare(engine.url.database)
+    app = Flask(__name__)
+    app.register_blueprint(run.BLUEPRINT)
+    yield app.test_client()
+    run.ENGINE.dispose()
+
+
+def test_summary(client):
+    response = client.get("/test/summary")
+    assert response.status_code == 200
+    columns = response.get_json()["columns"]
+    assert columns["subject"]["facets"][0] == {"value": "subject:1", "count": 1}
+    assert columns["weight"]["violations"]["error"] == 1
+    # Summaries are cached even without the response cache, but not forever
+    assert run.RESPONSE_CACHE is None
+    assert run.SUMMARY_CACHE.ttl == run.SUMMARY_TTL
+
+
+def test_summary_cache_ttl(engine):
+    run.prepare(engine.url.database, cache_options={"max_size": 1024, "ttl": 10})
+    assert run.SUMMARY_CACHE.ttl == 10
+    run.ENGINE.dispose()
+
+
+@pytest.mark.parametrize("metrics,log_timings", [(True, False), (False, True), (False, False)])
+def test_server_timing(engine, metrics, log_timings):
+    run.prepare(engine.url.database, metrics=metrics, log_timings=log_timings)
+    app = Flask(__name__)
+    app.register_blueprint(run.BLUEPRINT)
+    response = app.test_client().get("/test")
+    assert response.status_code == 200
+    # The header is only added with --metrics, not --log-timings
+    assert ("Server-Timing" in response.headers) == metrics
+    if metrics:
+        assert "sprocket_requests_total" in app.test_client().get("/-/metrics").get_data(True)
+    run.ENGINE.dispose()
+
+
+def test_violation_index_cgi(engine, monkeypatch, capsys):
+    # The index would be rebuilt for every request
+    monkeypatch.setattr("sys.argv", ["sprocket", engine.url.database, "--cgi", "--violation-index"])
+    with pytest.raises(SystemExit):
+        run.main()
+    assert "--violation-index cannot be used with --cgi" in capsys.readouterr().err